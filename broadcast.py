@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду всего и 1 сообщение в секунду в один чат
+GLOBAL_RATE = 25.0
+PER_CHAT_INTERVAL = 1.0
+CONCURRENCY = 10
+MAX_RETRIES = 3
+PROGRESS_INTERVAL = 5.0
+# Сколько отметок о доставке записывается в базу одной пачкой
+MARK_BATCH_SIZE = 200
+
+# Результаты доставки
+SENT = "sent"
+BLOCKED = "blocked"        # пользователь заблокировал бота или удалил аккаунт
+NOT_FOUND = "not_found"    # чат не найден
+FAILED = "failed"          # временная ошибка (сеть, сервер Telegram)
+# Недоступные навсегда: такие пользователи исключаются из следующих рассылок
+UNREACHABLE = (BLOCKED, NOT_FOUND)
+
+# Статистика выполняющихся заданий: job_id -> BroadcastStats
+active_jobs = {}
+
+SENDS = metrics.Counter("bot_broadcast_sends_total", "Broadcast deliveries by final result", ["result"])
+RETRY_AFTER = metrics.Counter("bot_broadcast_retry_after_total", "RetryAfter responses from Telegram")
+QUEUE_DEPTH = metrics.Gauge(
+    "bot_broadcast_queue_depth", "Recipients left in running broadcast jobs",
+    function=lambda: sum(stats.total - stats.done for stats in active_jobs.values() if stats.total is not None)
+)
+
+
+def classify_error(error: Exception) -> str:
+    """Категория ошибки отправки (TelegramRetryAfter обрабатывается отдельно)"""
+    if isinstance(error, TelegramForbiddenError):
+        return BLOCKED
+    if isinstance(error, TelegramBadRequest):
+        message = str(error).lower()
+        if "chat not found" in message or "user not found" in message:
+            return NOT_FOUND
+    return FAILED
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate отправок в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановить все отправки (после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # Время паузы не копится в токены: после неё отправки идут с обычной скоростью, без всплеска
+        self.tokens = 0.0
+        self.updated_at = self.paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат.
+
+    Помнятся только отправки за последние interval секунд, поэтому память
+    не растёт с числом получателей.
+    """
+
+    def __init__(self, interval: float = PER_CHAT_INTERVAL):
+        self.interval = interval
+        self.last_sent = OrderedDict()
+
+    async def wait(self, chat_id: int):
+        last = self.last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        now = time.monotonic()
+        self.last_sent[chat_id] = now
+        self.last_sent.move_to_end(chat_id)
+        # Отметки старше interval уже ни на что не влияют
+        while self.last_sent:
+            oldest_id, oldest = next(iter(self.last_sent.items()))
+            if now - oldest < self.interval:
+                break
+            del self.last_sent[oldest_id]
+
+
+class BroadcastStats:
+    def __init__(self, total: int = None, sent: int = 0, failed: int = 0):
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.retries = 0
+        self.unreachable = 0
+        self.started_at = time.monotonic()
+        self._initial = sent + failed
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started_at
+        return (self.done - self._initial) / elapsed if elapsed > 0 else 0.0
+
+
+async def run_broadcast(chat_ids, send, on_progress=None, on_result=None, stats: BroadcastStats = None,
+                        rate: float = GLOBAL_RATE, concurrency: int = CONCURRENCY,
+                        progress_interval: float = PROGRESS_INTERVAL):
+    """Рассылка с ограничением параллельности и скорости.
+
+    chat_ids — список или асинхронный итератор получателей.
+    send(chat_id) возвращает результат доставки (SENT, BLOCKED, NOT_FOUND, FAILED)
+    и может выбросить TelegramRetryAfter — тогда все отправки ставятся на паузу,
+    а сообщение отправляется повторно. Временные ошибки (FAILED) тоже повторяются.
+    on_result(chat_id, result) вызывается после каждого получателя,
+    on_progress(stats) — раз в progress_interval секунд и в конце.
+    """
+    if stats is None:
+        stats = BroadcastStats(len(chat_ids) if hasattr(chat_ids, "__len__") else None)
+    bucket = TokenBucket(rate)
+    chats = ChatLimiter()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def produce():
+        if hasattr(chat_ids, "__aiter__"):
+            async for chat_id in chat_ids:
+                await queue.put(chat_id)
+        else:
+            for chat_id in chat_ids:
+                await queue.put(chat_id)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def deliver(chat_id):
+        result = FAILED
+        for attempt in range(MAX_RETRIES + 1):
+            await chats.wait(chat_id)
+            await bucket.acquire()
+            try:
+                result = await send(chat_id)
+            except TelegramRetryAfter as e:
+                stats.retries += 1
+                RETRY_AFTER.inc()
+                logger.warning(f"Broadcast throttled for {e.retry_after}s")
+                bucket.pause(e.retry_after)
+                continue
+            if result != FAILED:
+                return result
+            # Временная ошибка: повторяем с нарастающей задержкой
+            stats.retries += 1
+            await asyncio.sleep(2 ** attempt)
+        return result
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            result = await deliver(chat_id)
+            SENDS.labels(result).inc()
+            if result == SENT:
+                stats.sent += 1
+            else:
+                stats.failed += 1
+                if result in UNREACHABLE:
+                    stats.unreachable += 1
+            if on_result:
+                await on_result(chat_id, result)
+
+    async def report():
+        while True:
+            await asyncio.sleep(progress_interval)
+            await _notify(on_progress, stats)
+
+    reporter = asyncio.create_task(report()) if on_progress else None
+    tasks = [asyncio.create_task(produce()), *(asyncio.create_task(worker()) for _ in range(concurrency))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Ошибка одной задачи (например, записи отметок) останавливает и остальные отправки
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if reporter:
+            reporter.cancel()
+
+    await _notify(on_progress, stats)
+    return stats
+
+
+async def run_job(job_id: int, send, on_progress=None, rate: float = GLOBAL_RATE,
+                  concurrency: int = CONCURRENCY, progress_interval: float = PROGRESS_INTERVAL):
+    """Выполнение (или продолжение после перезапуска) сохранённого задания рассылки.
+
+    Получатели, уже отмеченные в broadcast_deliveries, пропускаются;
+    отметки пишутся пачками и сбрасываются в базу даже при отмене задачи.
+    """
+    job = await db.get_broadcast_job(job_id)
+    _, _, _, _, _, sent_count, failed_count = job
+
+    # Получатели читаются из базы порциями по мере отправки
+    remaining = await db.count_broadcast_recipients(job_id)
+    recipients = db.iter_broadcast_recipients(job_id)
+    stats = BroadcastStats(sent_count + failed_count + remaining, sent_count, failed_count)
+
+    results = []
+
+    async def flush_results():
+        batch = results[:]
+        results.clear()
+        await db.mark_deliveries(job_id, batch)
+
+    async def on_result(chat_id, result):
+        results.append((chat_id, result))
+        if len(results) >= MARK_BATCH_SIZE:
+            await flush_results()
+
+    active_jobs[job_id] = stats
+    try:
+        await run_broadcast(
+            recipients, send, on_progress, on_result, stats,
+            rate=rate, concurrency=concurrency, progress_interval=progress_interval
+        )
+    finally:
+        del active_jobs[job_id]
+        # Сохраняем место, на котором остановились, даже при отмене
+        await asyncio.shield(flush_results())
+
+    await db.finish_broadcast_job(job_id)
+    return stats
+
+
+async def _notify(on_progress, stats: BroadcastStats):
+    if on_progress is None:
+        return
+    try:
+        await on_progress(stats)
+    except Exception as e:
+        logger.warning(f"Broadcast progress update failed: {e}")
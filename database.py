@@ -1,11 +1,766 @@
+import asyncio
+import gzip
+import inspect
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
 import aiosqlite
 
+import metrics
+from hll import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+DB_CALL_DURATION = metrics.Histogram(
+    "bot_db_call_duration_seconds", "Duration of database.py calls", ["function"]
+)
+
 DATABASE_PATH = "bot_database.db"
+READ_POOL_SIZE = 4
+# Сколько ожидающих записей объединяется в одну транзакцию (один commit)
+WRITE_BATCH_SIZE = 64
+
+# Настройки хранилища SQLite (переопределяются через open_pool)
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,       # в КиБ (отрицательное значение), ~16 МБ
+    "mmap_size": 134217728,     # 128 МБ
+    "busy_timeout": 5000,       # мс
+}
+_PRAGMA_CHOICES = {
+    "journal_mode": {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"},
+    "synchronous": {"OFF", "NORMAL", "FULL", "EXTRA"},
+}
+
+# Статусы пользователей, до которых нельзя доставить сообщение
+UNREACHABLE_STATUSES = ("blocked", "not_found")
+
+# Постов на одной странице списка
+POSTS_PAGE_SIZE = 10
+
+# Размер порции при потоковом обходе пользователей
+USER_CHUNK_SIZE = 1000
+
+# Сколько пользователей с известным профилем держать в памяти (повторный /start без записи)
+KNOWN_USERS_CACHE_SIZE = 10000
+# Сколько секунд настройки пользователя берутся из памяти без запроса к базе
+USER_SETTINGS_TTL = 60
+
+# Буфер отложенной записи просмотров и кликов: сброс по размеру или по таймеру
+EVENT_FLUSH_SIZE = 500
+EVENT_FLUSH_INTERVAL = 2.0  # секунды
+
+# Сводки статистики: как часто обновлять и сколько сырых событий брать за транзакцию
+ROLLUP_INTERVAL = 60.0  # секунды
+ROLLUP_CHUNK_SIZE = 10000
+
+# Хранение сырых событий: старше EVENT_RETENTION_DAYS дней удаляются (0 — хранить всё)
+EVENT_RETENTION_DAYS = 90
+RETENTION_CHUNK_SIZE = 5000
+RETENTION_INTERVAL = 3600.0  # секунды между проходами очистки
+VACUUM_STEP_PAGES = 1000
+
+# Время жизни кэша справочников, секунды
+CATALOG_TTL = 300
+
+# Постоянные соединения: одно на запись (им владеет задача-писатель), несколько на чтение
+_write_conn = None
+_write_queue = None
+_writer_task = None
+_read_conns = []
+_read_pool = None
+
+_view_events = []   # (post_id, user_id, viewed_at)
+_click_events = []  # (marathon_id, user_id, clicked_at)
+_pending_views = Counter()
+_pending_clicks = Counter()
+_flush_size = EVENT_FLUSH_SIZE
+_flush_wakeup = None
+_flusher_task = None
+_flushing = None          # задача текущей записи буфера
+_flush_generation = 0     # число завершённых записей буфера
+
+_compactor_task = None
+_incremental_vacuum = False
+
+_catalog = None
+_catalog_version = 0
+
+
+def _pragma_statements(pragmas: dict):
+    """PRAGMA-команды из настроек (значения проверяются, т.к. PRAGMA не принимает параметры)"""
+    statements = []
+    for name, value in pragmas.items():
+        if name in _PRAGMA_CHOICES:
+            value = str(value).upper()
+            if value not in _PRAGMA_CHOICES[name]:
+                raise ValueError(f"Недопустимое значение PRAGMA {name}: {value}")
+        elif name in ("cache_size", "mmap_size", "busy_timeout"):
+            value = int(value)
+        else:
+            raise ValueError(f"Неизвестная PRAGMA: {name}")
+        statements.append(f"PRAGMA {name} = {value}")
+    return statements
+
+
+async def open_pool(read_pool_size: int = READ_POOL_SIZE, pragmas: dict = None, vacuum: bool = False):
+    """Открытие постоянных соединений с базой (вызывается один раз при старте).
+
+    vacuum — перевести существующую базу в incremental auto_vacuum полным VACUUM;
+    на большой базе это долго, поэтому только по явному запросу (обслуживание).
+    """
+    global _write_conn, _write_queue, _writer_task, _read_pool
+    if _write_conn is not None:
+        return
+
+    settings = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+    statements = _pragma_statements(settings)
+
+    # Соединение на запись в режиме autocommit: транзакциями управляет задача-писатель
+    _write_conn = await aiosqlite.connect(DATABASE_PATH, isolation_level=None)
+    # Освобождённые страницы возвращаем постепенно (PRAGMA incremental_vacuum);
+    # до journal_mode, пока новая база ещё пуста
+    await _ensure_incremental_vacuum(vacuum)
+    for statement in statements:
+        await _write_conn.execute(statement)
+
+    # Соединения на чтение: в WAL читают снимок базы параллельно с записью
+    _read_pool = asyncio.Queue()
+    for _ in range(max(1, read_pool_size)):
+        conn = await aiosqlite.connect(DATABASE_PATH)
+        for statement in statements:
+            if not statement.startswith("PRAGMA journal_mode"):
+                await conn.execute(statement)
+        await conn.execute("PRAGMA query_only = ON")
+        _read_conns.append(conn)
+        _read_pool.put_nowait(conn)
+
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_writer_loop())
+
+
+async def _ensure_incremental_vacuum(vacuum: bool):
+    global _incremental_vacuum
+    cursor = await _write_conn.execute("PRAGMA auto_vacuum")
+    mode = (await cursor.fetchone())[0]
+    if mode != 2:
+        # Новая база переключается сразу; существующей нужен полный VACUUM
+        await _write_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor = await _write_conn.execute("PRAGMA auto_vacuum")
+        mode = (await cursor.fetchone())[0]
+        if mode != 2 and vacuum:
+            logger.info("Switching database to incremental auto_vacuum (full VACUUM)")
+            await _write_conn.execute("VACUUM")
+            mode = 2
+        if mode != 2:
+            logger.warning(
+                "Database is not in incremental auto_vacuum mode: pruned events will not shrink the file "
+                "until it is switched once with SQLITE_VACUUM_ON_START=1"
+            )
+    _incremental_vacuum = mode == 2
+
+
+async def close_pool():
+    """Закрытие всех соединений (вызывается при остановке)"""
+    global _write_conn, _write_queue, _writer_task, _read_pool
+    if _write_conn is None:
+        return
+
+    # Сначала компактор (он сам сбрасывает буфер), затем финальный сброс, пока писатель ещё работает
+    await stop_compactor()
+    await stop_event_buffer()
+
+    # Задача-писатель дописывает очередь и завершается
+    await _write_queue.put(None)
+    await _writer_task
+
+    await _write_conn.close()
+    for conn in _read_conns:
+        await conn.close()
+
+    _read_conns.clear()
+    _write_conn = None
+    _write_queue = None
+    _writer_task = None
+    _read_pool = None
+
+
+async def ping():
+    """Проверка базы: чтение и пустая транзакция записи (ждёт очередь писателя)"""
+    async with reading() as db:
+        await db.execute("SELECT 1")
+    async with writing():
+        pass
+
+
+@asynccontextmanager
+async def reading():
+    """Соединение из пула на чтение"""
+    if _read_pool is None:
+        raise RuntimeError("Пул соединений не открыт: вызовите open_pool()")
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+@asynccontextmanager
+async def writing():
+    """Соединение на запись: блок выполняется в транзакции задачи-писателя.
+
+    Выход из блока ждёт commit; при исключении изменения блока откатываются.
+    """
+    if _write_queue is None:
+        raise RuntimeError("Пул соединений не открыт: вызовите open_pool()")
+
+    loop = asyncio.get_running_loop()
+    granted, released, committed = loop.create_future(), loop.create_future(), loop.create_future()
+    await _write_queue.put((granted, released, committed))
+
+    try:
+        conn = await granted
+    except asyncio.CancelledError:
+        # Писатель мог успеть выдать соединение — возвращаем его
+        if granted.done() and not granted.cancelled():
+            released.set_exception(asyncio.CancelledError())
+        raise
+
+    try:
+        yield conn
+    except BaseException as e:
+        released.set_exception(e)
+        raise
+    released.set_result(None)
+    await committed
+
+
+async def _writer_loop():
+    """Единственная задача, пишущая в базу: групповой commit ожидающих записей"""
+    stopping = False
+    while not stopping:
+        request = await _write_queue.get()
+        if request is None:
+            break
+        batch = [request]
+        while len(batch) < WRITE_BATCH_SIZE and not _write_queue.empty():
+            request = _write_queue.get_nowait()
+            if request is None:
+                stopping = True
+                break
+            batch.append(request)
+
+        try:
+            await _run_write_batch(batch)
+        except Exception as e:
+            logger.exception("Write batch failed")
+            for granted, released, committed in batch:
+                for future in (granted, committed):
+                    if not future.done():
+                        future.set_exception(e)
+
+
+async def _run_write_batch(batch: list):
+    """Каждая запись — в своём SAVEPOINT, вся пачка — в одной транзакции"""
+    done = []
+    await _write_conn.execute("BEGIN IMMEDIATE")
+    try:
+        for granted, released, committed in batch:
+            if granted.done():  # вызывающий отменён до получения соединения
+                continue
+            await _write_conn.execute("SAVEPOINT write_op")
+            granted.set_result(_write_conn)
+            try:
+                await released
+            except BaseException:
+                await _write_conn.execute("ROLLBACK TO write_op")
+                await _write_conn.execute("RELEASE write_op")
+                if not committed.done():
+                    committed.cancel()
+                continue
+            await _write_conn.execute("RELEASE write_op")
+            done.append(committed)
+        await _write_conn.execute("COMMIT")
+    except BaseException:
+        if _write_conn.in_transaction:
+            await _write_conn.execute("ROLLBACK")
+        raise
+
+    for committed in done:
+        if not committed.done():
+            committed.set_result(None)
+
+
+# ========== Отложенная запись событий ==========
+def _utc_timestamp():
+    """Текущее время в формате CURRENT_TIMESTAMP (UTC)"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def start_event_buffer(flush_interval: float = EVENT_FLUSH_INTERVAL, flush_size: int = EVENT_FLUSH_SIZE):
+    """Запуск фоновой задачи, сбрасывающей просмотры и клики в базу"""
+    global _flush_size, _flush_wakeup, _flusher_task
+    if _flusher_task is not None:
+        return
+    _flush_size = flush_size
+    _flush_wakeup = asyncio.Event()
+    _flusher_task = asyncio.create_task(_flusher_loop(flush_interval))
+
+
+async def stop_event_buffer():
+    """Остановка фоновой задачи и финальный сброс буфера"""
+    global _flush_wakeup, _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+        _flush_wakeup = None
+    await flush_events()
+
+
+async def _flusher_loop(flush_interval: float):
+    while True:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        try:
+            await flush_events()
+        except Exception:
+            logger.exception("Event flush failed")
+
+
+def _buffer_event(events: list, event: tuple):
+    events.append(event)
+    if _flush_wakeup is not None and len(_view_events) + len(_click_events) >= _flush_size:
+        _flush_wakeup.set()
+
+
+def pending_events_count():
+    """Количество событий, ещё не записанных в базу"""
+    return len(_view_events) + len(_click_events)
+
+
+async def flush_events():
+    """Запись накопленных просмотров и кликов одной транзакцией"""
+    global _view_events, _click_events, _flushing
+    # Сброс, начатый отменённым вызовом, ещё может идти — ждём его, чтобы не обогнать
+    while _flushing is not None:
+        await asyncio.wait({_flushing})
+    if not _view_events and not _click_events:
+        return
+
+    views, clicks = _view_events, _click_events
+    _view_events, _click_events = [], []
+    # Запись не прерывается отменой вызывающего: иначе закоммиченная пачка вернулась бы в буфер
+    _flushing = asyncio.create_task(_write_events(views, clicks))
+    await asyncio.shield(_flushing)
+
+
+async def _write_events(views: list, clicks: list):
+    global _flushing, _flush_generation
+    views_per_post = Counter(post_id for post_id, _, _ in views)
+    clicks_per_marathon = Counter(marathon_id for marathon_id, _, _ in clicks)
+
+    try:
+        async with writing() as db:
+            if views:
+                await db.executemany(
+                    "UPDATE posts SET views = views + ? WHERE id = ?",
+                    [(n, post_id) for post_id, n in views_per_post.items()]
+                )
+                await db.executemany(
+                    "INSERT INTO post_views (post_id, user_id, viewed_at) VALUES (?, ?, ?)", views
+                )
+                await _update_sketches(db, "post", views)
+            if clicks:
+                await db.executemany(
+                    "UPDATE marathons SET clicks = clicks + ? WHERE id = ?",
+                    [(n, marathon_id) for marathon_id, n in clicks_per_marathon.items()]
+                )
+                await db.executemany(
+                    "INSERT INTO marathon_clicks (marathon_id, user_id, clicked_at) VALUES (?, ?, ?)", clicks
+                )
+                await _update_sketches(db, "marathon", clicks)
+    except BaseException:
+        # Транзакция не закоммичена — возвращаем события в буфер, чтобы не потерять их
+        _view_events[:0] = views
+        _click_events[:0] = clicks
+        raise
+    else:
+        _pending_views.subtract(views_per_post)
+        _pending_clicks.subtract(clicks_per_marathon)
+        for counter in (_pending_views, _pending_clicks):
+            for key in [k for k, n in counter.items() if n <= 0]:
+                del counter[key]
+    finally:
+        _flushing = None
+        _flush_generation += 1
+
+
+# ========== Уникальный охват ==========
+# Для каждого поста и марафона хранятся слепки HyperLogLog по дням и за всё время
+# (day = ''); уникальные за неделю и месяц — объединение дневных слепков.
+async def _update_sketches(db, kind: str, events):
+    """Добавить пользователей из событий (item_id, user_id, timestamp) в слепки"""
+    users = {}
+    for item_id, user_id, timestamp in events:
+        users.setdefault((item_id, timestamp[:10]), set()).add(user_id)
+        users.setdefault((item_id, ""), set()).add(user_id)
+
+    rows = []
+    for (item_id, day), user_ids in users.items():
+        cursor = await db.execute(
+            "SELECT sketch FROM reach_sketches WHERE kind = ? AND item_id = ? AND day = ?",
+            (kind, item_id, day)
+        )
+        row = await cursor.fetchone()
+        sketch = HyperLogLog(row[0]) if row else HyperLogLog()
+        rows.append((kind, item_id, day, sketch.update(user_ids).to_bytes()))
+
+    await db.executemany(
+        """
+        INSERT INTO reach_sketches (kind, item_id, day, sketch) VALUES (?, ?, ?, ?)
+        ON CONFLICT (kind, item_id, day) DO UPDATE SET sketch = excluded.sketch
+        """,
+        rows
+    )
+
+
+async def get_reach(kind: str, item_id: int):
+    """Уникальные пользователи (за 7 дней, за 30 дней, за всё время)"""
+    today = datetime.now(timezone.utc).date()
+    week_start = (today - timedelta(days=6)).isoformat()
+    month_start = (today - timedelta(days=29)).isoformat()
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT day, sketch FROM reach_sketches "
+            "WHERE kind = ? AND item_id = ? AND (day = '' OR day >= ?)",
+            (kind, item_id, month_start)
+        )
+        rows = await cursor.fetchall()
+
+    week, month, total = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for day, blob in rows:
+        sketch = HyperLogLog(blob)
+        if day == "":
+            total = sketch
+            continue
+        month.merge(sketch)
+        if day >= week_start:
+            week.merge(sketch)
+    return week.count(), month.count(), total.count()
+
+
+async def backfill_sketches(chunk_size: int = ROLLUP_CHUNK_SIZE):
+    """Заполнение слепков по событиям, сохранённым до их появления (миграция 7).
+
+    Идёт в фоне из компактора, порциями в коротких транзакциях; события после
+    миграции попадают в слепки при записи буфера. Повторное добавление
+    пользователя в слепок ничего не меняет, поэтому прерывание безопасно.
+    """
+    total = 0
+    for source, spec in _ROLLUP_SOURCES.items():
+        while True:
+            async with writing() as db:
+                cursor = await db.execute("SELECT last_id, until_id FROM sketch_backfill WHERE source = ?", (source,))
+                row = await cursor.fetchone()
+                if row is None:
+                    break
+                last_id, until_id = row
+                cursor = await db.execute(
+                    f"SELECT id, {spec['key']}, user_id, {spec['time']} FROM {source} "
+                    f"WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                    (last_id, until_id, chunk_size)
+                )
+                rows = await cursor.fetchall()
+                if rows:
+                    await _update_sketches(db, spec["sketch"], [row[1:] for row in rows])
+                if len(rows) < chunk_size:
+                    await db.execute("DELETE FROM sketch_backfill WHERE source = ?", (source,))
+                else:
+                    await db.execute(
+                        "UPDATE sketch_backfill SET last_id = ? WHERE source = ?", (rows[-1][0], source)
+                    )
+            total += len(rows)
+            if len(rows) < chunk_size:
+                break
+    if total:
+        logger.info(f"Backfilled reach sketches from {total} stored events")
+    return total
+
+
+# ========== Сводки статистики ==========
+# Сырые события (post_views, marathon_clicks) по возрастанию id сворачиваются
+# в почасовые и дневные таблицы; rollup_state хранит последний учтённый id.
+_ROLLUP_SOURCES = {
+    "post_views": {
+        "time": "viewed_at", "key": "post_id", "counter": "views",
+        "hourly": "post_views_hourly", "daily": "post_views_daily", "sketch": "post",
+    },
+    "marathon_clicks": {
+        "time": "clicked_at", "key": "marathon_id", "counter": "clicks",
+        "hourly": "marathon_clicks_hourly", "daily": "marathon_clicks_daily", "sketch": "marathon",
+    },
+}
+
+
+async def _rollup_chunk(db, source: str, chunk_size: int):
+    """Свернуть очередную порцию событий source; возвращает число учтённых событий"""
+    spec = _ROLLUP_SOURCES[source]
+    cursor = await db.execute("SELECT last_id FROM rollup_state WHERE source = ?", (source,))
+    row = await cursor.fetchone()
+    last_id = row[0] if row else 0
+
+    cursor = await db.execute(
+        f"SELECT MAX(id), COUNT(*) FROM (SELECT id FROM {source} WHERE id > ? ORDER BY id LIMIT ?)",
+        (last_id, chunk_size)
+    )
+    max_id, count = await cursor.fetchone()
+    if not count:
+        return 0
+
+    time_col, key, counter = spec["time"], spec["key"], spec["counter"]
+    chunk = f"FROM {source} WHERE id > {int(last_id)} AND id <= {int(max_id)}"
+    await db.execute(f'''
+        INSERT INTO {spec["hourly"]} (hour, {key}, {counter})
+        SELECT strftime('%Y-%m-%d %H:00', {time_col}), {key}, COUNT(*) {chunk} GROUP BY 1, 2
+        ON CONFLICT DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''')
+    await db.execute(f'''
+        INSERT INTO {spec["daily"]} (day, {key}, {counter})
+        SELECT date({time_col}), {key}, COUNT(*) {chunk} GROUP BY 1, 2
+        ON CONFLICT DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''')
+    await db.execute(f'''
+        INSERT INTO daily_totals (day, {counter})
+        SELECT date({time_col}), COUNT(*) {chunk} GROUP BY 1
+        ON CONFLICT DO UPDATE SET {counter} = {counter} + excluded.{counter}
+    ''')
+    await db.execute(f'''
+        INSERT OR IGNORE INTO daily_active_users (day, user_id)
+        SELECT DISTINCT date({time_col}), user_id {chunk} AND user_id IS NOT NULL
+    ''')
+    # Пересчёт активных пользователей только для затронутых дней (поиск по ключу)
+    await db.execute(f'''
+        UPDATE daily_totals SET active_users = (
+            SELECT COUNT(*) FROM daily_active_users d WHERE d.day = daily_totals.day
+        )
+        WHERE day IN (SELECT DISTINCT date({time_col}) {chunk})
+    ''')
+    await db.execute(
+        "INSERT INTO rollup_state (source, last_id) VALUES (?, ?) "
+        "ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id",
+        (source, max_id)
+    )
+    return count
+
+
+async def compact_events(chunk_size: int = ROLLUP_CHUNK_SIZE):
+    """Догнать сводки до последних событий; каждая порция — отдельная короткая транзакция"""
+    total = 0
+    for source in _ROLLUP_SOURCES:
+        while True:
+            async with writing() as db:
+                count = await _rollup_chunk(db, source, chunk_size)
+            total += count
+            if count < chunk_size:
+                break
+    return total
+
+
+def start_compactor(interval: float = ROLLUP_INTERVAL, retention_days: int = EVENT_RETENTION_DAYS,
+                    archive_dir: str = None):
+    """Запуск фоновой задачи, обновляющей сводки и удаляющей старые сырые события"""
+    global _compactor_task
+    if _compactor_task is None:
+        _compactor_task = asyncio.create_task(_compactor_loop(interval, retention_days, archive_dir))
+
+
+async def stop_compactor():
+    global _compactor_task
+    if _compactor_task is not None:
+        _compactor_task.cancel()
+        try:
+            await _compactor_task
+        except asyncio.CancelledError:
+            pass
+        _compactor_task = None
+
+
+async def _compactor_loop(interval: float, retention_days: int, archive_dir: str):
+    last_pruned_at = None
+    while True:
+        try:
+            await flush_events()
+            await compact_events()
+            await backfill_sketches()
+            if retention_days and (last_pruned_at is None or time.monotonic() - last_pruned_at >= RETENTION_INTERVAL):
+                last_pruned_at = time.monotonic()
+                await prune_events(retention_days, archive_dir)
+        except Exception:
+            logger.exception("Event rollup failed")
+        await asyncio.sleep(interval)
+
+
+# ========== Хранение сырых событий ==========
+def _archive_rows(archive_dir: str, source: str, columns: tuple, rows: list):
+    """Дописать события в сжатые NDJSON-файлы по дням: <source>-<YYYY-MM-DD>.ndjson.gz"""
+    os.makedirs(archive_dir, exist_ok=True)
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(row[-1][:10], []).append(row)
+    for day, day_rows in by_day.items():
+        path = os.path.join(archive_dir, f"{source}-{day}.ndjson.gz")
+        # Дописывание в gzip создаёт новый member — файл читается как единый поток
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for row in day_rows:
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+
+
+async def prune_events(retention_days: int = EVENT_RETENTION_DAYS, archive_dir: str = None,
+                       chunk_size: int = RETENTION_CHUNK_SIZE):
+    """Удаление сырых событий старше retention_days дней.
+
+    Удаляются только события, уже учтённые в сводках. Если задан archive_dir,
+    события перед удалением выгружаются в сжатый NDJSON. Удаление идёт
+    порциями — каждая в своей короткой транзакции, — затем освобождённое
+    место возвращается через incremental_vacuum.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    deleted = 0
+
+    for source, spec in _ROLLUP_SOURCES.items():
+        time_col, key = spec["time"], spec["key"]
+        columns = ("id", key, "user_id", time_col)
+        async with reading() as db:
+            cursor = await db.execute("SELECT last_id FROM rollup_state WHERE source = ?", (source,))
+            row = await cursor.fetchone()
+        watermark = row[0] if row else 0
+
+        while True:
+            async with reading() as db:
+                cursor = await db.execute(
+                    f"SELECT {', '.join(columns)} FROM {source} "
+                    f"WHERE id <= ? AND {time_col} < ? ORDER BY id LIMIT ?",
+                    (watermark, cutoff, chunk_size)
+                )
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+
+            if archive_dir:
+                await asyncio.to_thread(_archive_rows, archive_dir, source, columns, rows)
+
+            async with writing() as db:
+                await db.execute(
+                    f"DELETE FROM {source} WHERE id >= ? AND id <= ? AND {time_col} < ?",
+                    (rows[0][0], rows[-1][0], cutoff)
+                )
+            deleted += len(rows)
+            if len(rows) < chunk_size:
+                break
+
+    # Дневные слепки охвата старше срока хранения тоже не нужны (слепок за всё время остаётся),
+    # как и почасовые сводки и списки активных пользователей по дням: за всё время
+    # хранятся дневные сводки и daily_totals
+    async with writing() as db:
+        await db.execute(
+            "DELETE FROM reach_sketches WHERE day != '' AND day < ?",
+            (cutoff[:10],)
+        )
+        for spec in _ROLLUP_SOURCES.values():
+            await db.execute(f"DELETE FROM {spec['hourly']} WHERE hour < ?", (cutoff[:10],))
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT DISTINCT day FROM daily_active_users WHERE day < ? ORDER BY day", (cutoff[:10],)
+        )
+        days = [row[0] for row in await cursor.fetchall()]
+    for day in days:
+        # По дню за транзакцию: в первый проход дней может накопиться много
+        async with writing() as db:
+            await db.execute("DELETE FROM daily_active_users WHERE day = ?", (day,))
+
+    if deleted:
+        logger.info(f"Pruned {deleted} raw events older than {retention_days} days")
+        await reclaim_space()
+    return deleted
+
+
+async def reclaim_space(step_pages: int = VACUUM_STEP_PAGES):
+    """Вернуть свободные страницы файлу базы небольшими шагами"""
+    if not _incremental_vacuum:
+        # Без incremental auto_vacuum страницы остаются в базе и используются повторно
+        return
+    while True:
+        async with reading() as db:
+            cursor = await db.execute("PRAGMA freelist_count")
+            free_pages = (await cursor.fetchone())[0]
+        if not free_pages:
+            return
+        async with writing() as db:
+            cursor = await db.execute(f"PRAGMA incremental_vacuum({min(free_pages, int(step_pages))})")
+            await cursor.fetchall()
+
+
+async def get_dashboard(days: int = 7, top: int = 5):
+    """Все цифры админской статистики одним запросом по сводным таблицам"""
+    async with reading() as db:
+        cursor = await db.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM users WHERE status = 'blocked'),
+                (SELECT COUNT(*) FROM users WHERE status = 'not_found'),
+                (SELECT COUNT(*) FROM posts),
+                (SELECT COALESCE(SUM(views), 0) FROM daily_totals),
+                (SELECT COALESCE(SUM(clicks), 0) FROM daily_totals),
+                (SELECT json_group_array(json_array(day, views, clicks, active_users)) FROM (
+                    SELECT day, views, clicks, active_users FROM daily_totals
+                    WHERE day >= date('now', :since) ORDER BY day DESC
+                )),
+                (SELECT json_group_array(json_array(title, total)) FROM (
+                    SELECT p.title, SUM(d.views) AS total FROM post_views_daily d
+                    JOIN posts p ON p.id = d.post_id
+                    WHERE d.day >= date('now', :since)
+                    GROUP BY d.post_id ORDER BY total DESC LIMIT :top
+                )),
+                (SELECT json_group_array(json_array(name, total)) FROM (
+                    SELECT m.emoji || ' ' || m.name AS name, SUM(d.clicks) AS total FROM marathon_clicks_daily d
+                    JOIN marathons m ON m.id = d.marathon_id
+                    WHERE d.day >= date('now', :since)
+                    GROUP BY d.marathon_id ORDER BY total DESC LIMIT :top
+                ))
+        ''', {"since": f"-{days - 1} days", "top": top})
+        row = await cursor.fetchone()
+
+    users, blocked, not_found, posts, views, clicks, trend, top_posts, top_links = row
+    return {
+        "users": users,
+        "blocked": blocked,
+        "not_found": not_found,
+        "posts": posts,
+        "views": views,
+        "clicks": clicks,
+        "trend": json.loads(trend),          # [(day, views, clicks, active_users)], новые сначала
+        "top_posts": json.loads(top_posts),  # [(title, views)]
+        "top_links": json.loads(top_links),  # [(name, clicks)]
+    }
 
 
 async def init_db():
     """Инициализация базы данных"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         # Таблица пользователей
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -87,10 +842,234 @@ async def init_db():
             )
         ''')
 
-        await db.commit()
+        # Применяем миграции схемы
+        await run_migrations(db)
 
         # Добавляем начальные категории если их нет
         await add_initial_data(db)
+    invalidate_catalog()
+
+
+# ========== Миграции схемы ==========
+# Версия схемы хранится в PRAGMA user_version. Миграция N — список SQL-команд
+# или функция async (db); новые миграции только добавляются в конец списка.
+MIGRATIONS = [
+    # 1: индексы выборок постов и подкатегорий (покрывают id и заголовок)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_posts_category ON posts (category_id, id, title)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_subcategory ON posts (subcategory_id, id, title)",
+        "CREATE INDEX IF NOT EXISTS idx_subcategories_category ON subcategories (category_id, id, name)",
+    ],
+    # 2: индексы таблиц событий по объекту, пользователю и дате
+    [
+        "CREATE INDEX IF NOT EXISTS idx_post_views_post ON post_views (post_id, viewed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_post_views_user ON post_views (user_id, viewed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_post_views_date ON post_views (viewed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_marathon_clicks_marathon ON marathon_clicks (marathon_id, clicked_at)",
+        "CREATE INDEX IF NOT EXISTS idx_marathon_clicks_user ON marathon_clicks (user_id, clicked_at)",
+        "CREATE INDEX IF NOT EXISTS idx_marathon_clicks_date ON marathon_clicks (clicked_at)",
+    ],
+    # 3: задания рассылки и отметки о доставке каждому получателю
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            sent_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, user_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 4: статус доставки пользователя (active / blocked / not_found)
+    [
+        "ALTER TABLE users ADD COLUMN status TEXT NOT NULL DEFAULT 'active'",
+        "CREATE INDEX IF NOT EXISTS idx_users_status ON users (status)",
+    ],
+    # 5: полнотекстовый поиск по постам (FTS5), индекс поддерживается триггерами
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            title, description,
+            content='posts', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, description ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO posts_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+        END
+        ''',
+        "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    ],
+    # 6: почасовые и дневные сводки по просмотрам и кликам, активные пользователи по дням
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS post_views_hourly (
+            hour TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            views INTEGER NOT NULL,
+            PRIMARY KEY (hour, post_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS post_views_daily (
+            day TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            views INTEGER NOT NULL,
+            PRIMARY KEY (day, post_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS marathon_clicks_hourly (
+            hour TEXT NOT NULL,
+            marathon_id INTEGER NOT NULL,
+            clicks INTEGER NOT NULL,
+            PRIMARY KEY (hour, marathon_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS marathon_clicks_daily (
+            day TEXT NOT NULL,
+            marathon_id INTEGER NOT NULL,
+            clicks INTEGER NOT NULL,
+            PRIMARY KEY (day, marathon_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            day TEXT PRIMARY KEY,
+            views INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        # До какого id события уже учтены в сводках
+        '''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+        ''',
+    ],
+    # 7: слепки HyperLogLog для уникального охвата постов и марафонов; уже сохранённые
+    # события учитываются в фоне (backfill_sketches), чтобы не задерживать запуск
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS reach_sketches (
+            kind TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (kind, item_id, day)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sketch_backfill (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            until_id INTEGER NOT NULL
+        )
+        ''',
+        "INSERT INTO sketch_backfill SELECT 'post_views', 0, MAX(id) FROM post_views HAVING MAX(id) IS NOT NULL",
+        "INSERT INTO sketch_backfill SELECT 'marathon_clicks', 0, MAX(id) FROM marathon_clicks HAVING MAX(id) IS NOT NULL",
+    ],
+    # 8: состояния FSM (незавершённые сценарии админки) со сроком жизни
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_records (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            expires_at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_fsm_records_expires ON fsm_records (expires_at)",
+    ],
+    # 9: подписки пользователей на категории (нет строки — подписан)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_category_subscriptions (
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            subscribed INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_id, category_id)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 10: отложенные публикации (время — секунды epoch)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            scheduled_at REAL NOT NULL,
+            offpeak INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            status_chat_id INTEGER,
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_due ON scheduled_posts (status, scheduled_at)",
+    ],
+]
+
+
+async def get_schema_version(db):
+    cursor = await db.execute("PRAGMA user_version")
+    result = await cursor.fetchone()
+    return result[0] if result else 0
+
+
+async def run_migrations(db):
+    """Применение ещё не выполненных миграций по порядку"""
+    version = await get_schema_version(db)
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        if callable(migration):
+            await migration(db)
+        else:
+            for statement in migration:
+                await db.execute(statement)
+        await db.execute(f"PRAGMA user_version = {number}")
+        logger.info(f"Schema migrated to version {number}")
 
 
 async def add_initial_data(db):
@@ -127,12 +1106,10 @@ async def add_initial_data(db):
                 (name, url, emoji)
             )
 
-    await db.commit()
-
 
 async def restore_marathons():
     """Восстановление марафонов если удалены"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         marathons = [
             ("Иду в лс к Грошевой", "http://t.me/groshevatanka", "➡️"),
             ("Стать клиентом", "https://nlstar.com/ref/ZeTJmV/", "➡️"),
@@ -147,112 +1124,226 @@ async def restore_marathons():
                     "INSERT INTO marathons (name, url, emoji) VALUES (?, ?, ?)",
                     (name, url, emoji)
                 )
-
-        await db.commit()
+    invalidate_catalog()
 
 
 # ========== Пользователи ==========
+# user_id -> (username, first_name) активных пользователей, уже записанных в базу
+_known_users = OrderedDict()
+# user_id -> (срок годности, настройки) для get_user_settings
+_user_settings = OrderedDict()
+
+
+def _remember_user(user_id: int, profile: tuple):
+    _known_users[user_id] = profile
+    _known_users.move_to_end(user_id)
+    if len(_known_users) > KNOWN_USERS_CACHE_SIZE:
+        _known_users.popitem(last=False)
+
+
 async def add_user(user_id: int, username: str = None, first_name: str = None):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    """Регистрация пользователя при /start.
+
+    Настройки и дата регистрации существующего пользователя не меняются;
+    строка перезаписывается, только если изменилось имя или пользователь
+    снова стал доступен. Повторный /start известного пользователя — без записи.
+    """
+    profile = (username, first_name)
+    if _known_users.get(user_id) == profile:
+        _known_users.move_to_end(user_id)
+        return
+
+    async with writing() as db:
         await db.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name) 
+            INSERT INTO users (user_id, username, first_name)
             VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                status = 'active'
+            WHERE username IS NOT excluded.username
+               OR first_name IS NOT excluded.first_name
+               OR status != 'active'
         ''', (user_id, username, first_name))
-        await db.commit()
+    _remember_user(user_id, profile)
+    _user_settings.pop(user_id, None)
 
 
-async def get_all_users():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT user_id, notifications_enabled FROM users")
-        return await cursor.fetchall()
+async def get_user_settings(user_id: int):
+    """(notifications_enabled, status) пользователя или None, если его нет в базе"""
+    cached = _user_settings.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT notifications_enabled, status FROM users WHERE user_id = ?", (user_id,)
+        )
+        settings = await cursor.fetchone()
+    _cache_user_settings(user_id, settings)
+    return settings
 
 
-async def get_users_count():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        result = await cursor.fetchone()
-        return result[0] if result else 0
+def _cache_user_settings(user_id: int, settings):
+    _user_settings[user_id] = (time.monotonic() + USER_SETTINGS_TTL, settings)
+    _user_settings.move_to_end(user_id)
+    if len(_user_settings) > KNOWN_USERS_CACHE_SIZE:
+        _user_settings.popitem(last=False)
 
 
 async def toggle_notifications(user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    """Переключение уведомлений одним запросом; возвращает новое значение"""
+    async with writing() as db:
         cursor = await db.execute(
-            "SELECT notifications_enabled FROM users WHERE user_id = ?", (user_id,)
+            """
+            INSERT INTO users (user_id, notifications_enabled) VALUES (?, 0)
+            ON CONFLICT (user_id) DO UPDATE SET notifications_enabled = 1 - notifications_enabled
+            RETURNING notifications_enabled, status
+            """,
+            (user_id,)
         )
-        result = await cursor.fetchone()
-        new_value = 0 if result and result[0] == 1 else 1
-        await db.execute(
-            "UPDATE users SET notifications_enabled = ? WHERE user_id = ?",
-            (new_value, user_id)
+        settings = await cursor.fetchone()
+    _cache_user_settings(user_id, settings)
+    return settings[0]
+
+
+# ========== Подписки на категории ==========
+# По умолчанию пользователь получает рассылки всех категорий; строка с subscribed = 0 — отписка
+async def get_unsubscribed_categories(user_id: int):
+    """id категорий, от рассылок которых пользователь отписался"""
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT category_id FROM user_category_subscriptions WHERE user_id = ? AND subscribed = 0",
+            (user_id,)
+        )
+        return {row[0] for row in await cursor.fetchall()}
+
+
+async def toggle_category_subscription(user_id: int, category_id: int):
+    """Переключение подписки на категорию одним запросом; возвращает новое значение"""
+    async with writing() as db:
+        cursor = await db.execute(
+            """
+            INSERT INTO user_category_subscriptions (user_id, category_id, subscribed) VALUES (?, ?, 0)
+            ON CONFLICT (user_id, category_id) DO UPDATE SET subscribed = 1 - subscribed
+            RETURNING subscribed
+            """,
+            (user_id, category_id)
         )
-        await db.commit()
-        return new_value
+        return (await cursor.fetchone())[0]
+
+
+# ========== Кэш справочников ==========
+# Категории, подкатегории и марафоны целиком держатся в памяти. Изменения через
+# функции этого модуля увеличивают версию и сбрасывают кэш; CATALOG_TTL
+# ограничивает устаревание, если базу меняет другой процесс.
+def catalog_version():
+    """Версия справочников: меняется при каждом изменении категорий, подкатегорий и марафонов"""
+    return _catalog_version
+
+
+def invalidate_catalog():
+    global _catalog, _catalog_version
+    _catalog = None
+    _catalog_version += 1
+
+
+async def _get_catalog():
+    global _catalog, _catalog_version
+    if _catalog is not None and time.monotonic() - _catalog["loaded_at"] < CATALOG_TTL:
+        return _catalog
+    if _catalog is not None:
+        # Истёк TTL — перечитываем и меняем версию (данные могли измениться извне)
+        invalidate_catalog()
+
+    version = _catalog_version
+    while True:
+        # Клики из базы и из буфера должны относиться к одному моменту: если запись
+        # буфера закоммитилась во время чтения, одни и те же клики учлись бы дважды
+        while _flushing is not None:
+            await asyncio.wait({_flushing})
+        generation = _flush_generation
+        async with reading() as db:
+            cursor = await db.execute("SELECT id, name, emoji FROM categories ORDER BY id")
+            categories = await cursor.fetchall()
+            cursor = await db.execute("SELECT id, name, category_id FROM subcategories ORDER BY id")
+            subcategories = await cursor.fetchall()
+            cursor = await db.execute("SELECT id, name, url, emoji, clicks FROM marathons ORDER BY id")
+            marathons = await cursor.fetchall()
+        if _flushing is None and generation == _flush_generation:
+            break
+
+    catalog = {
+        "loaded_at": time.monotonic(),
+        "categories": categories,
+        "categories_by_id": {row[0]: row for row in categories},
+        "subcategories_by_id": {row[0]: row for row in subcategories},
+        "subcategories_by_category": {},
+        # Клики, ещё не сброшенные из буфера, учитываем сразу
+        "marathons": {
+            row[0]: row[:-1] + (row[-1] + _pending_clicks[row[0]],) for row in marathons
+        },
+    }
+    for sub_id, name, category_id in subcategories:
+        catalog["subcategories_by_category"].setdefault(category_id, []).append((sub_id, name))
+
+    # Если справочники изменились во время загрузки, не сохраняем устаревшие данные
+    if version == _catalog_version:
+        _catalog = catalog
+    return catalog
 
 
 # ========== Категории ==========
 async def get_categories():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT id, name, emoji FROM categories")
-        return await cursor.fetchall()
+    return (await _get_catalog())["categories"]
 
 
 async def get_category(category_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, name, emoji FROM categories WHERE id = ?", (category_id,)
-        )
-        return await cursor.fetchone()
+    return (await _get_catalog())["categories_by_id"].get(category_id)
 
 
 async def add_category(name: str, emoji: str = ""):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "INSERT INTO categories (name, emoji) VALUES (?, ?)", (name, emoji)
         )
-        await db.commit()
+    invalidate_catalog()
 
 
 async def delete_category(category_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute("DELETE FROM categories WHERE id = ?", (category_id,))
-        await db.commit()
+        await db.execute("DELETE FROM user_category_subscriptions WHERE category_id = ?", (category_id,))
+    invalidate_catalog()
 
 
 # ========== Подкатегории ==========
 async def get_subcategories(category_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, name FROM subcategories WHERE category_id = ?", (category_id,)
-        )
-        return await cursor.fetchall()
+    return (await _get_catalog())["subcategories_by_category"].get(category_id, [])
 
 
 async def get_subcategory(subcategory_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, name, category_id FROM subcategories WHERE id = ?", (subcategory_id,)
-        )
-        return await cursor.fetchone()
+    return (await _get_catalog())["subcategories_by_id"].get(subcategory_id)
 
 
 async def add_subcategory(name: str, category_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "INSERT INTO subcategories (name, category_id) VALUES (?, ?)",
             (name, category_id)
         )
-        await db.commit()
+    invalidate_catalog()
 
 
 async def delete_subcategory(subcategory_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute("DELETE FROM subcategories WHERE id = ?", (subcategory_id,))
-        await db.commit()
+    invalidate_catalog()
 
 
 # ========== Посты ==========
 async def get_posts(category_id: int = None, subcategory_id: int = None):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with reading() as db:
         if subcategory_id:
             cursor = await db.execute(
                 "SELECT id, title, description, media_type, media_file_id, views FROM posts WHERE subcategory_id = ?",
@@ -270,29 +1361,90 @@ async def get_posts(category_id: int = None, subcategory_id: int = None):
         return await cursor.fetchall()
 
 
+async def get_post_titles_page(category_id: int = None, subcategory_id: int = None,
+                               after_id: int = None, before_id: int = None, limit: int = POSTS_PAGE_SIZE):
+    """Страница (id, title) постов по ключу id — после after_id или перед before_id.
+
+    Возвращает (rows, has_prev, has_next). Страница — один запрос по индексу,
+    лишняя строка в LIMIT показывает, есть ли посты дальше.
+    """
+    if subcategory_id:
+        where, params = "subcategory_id = ?", [subcategory_id]
+    elif category_id:
+        where, params = "category_id = ?", [category_id]
+    else:
+        where, params = "1", []
+
+    async with reading() as db:
+        if before_id is not None:
+            cursor = await db.execute(
+                f"SELECT id, title FROM posts WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?",
+                (*params, before_id, limit + 1)
+            )
+            rows = await cursor.fetchall()
+            has_prev, has_next = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            cursor = await db.execute(
+                f"SELECT id, title FROM posts WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+                (*params, after_id or 0, limit + 1)
+            )
+            rows = await cursor.fetchall()
+            has_prev, has_next = after_id is not None, len(rows) > limit
+            rows = rows[:limit]
+    return rows, has_prev, has_next
+
+
+def _fts_query(text: str):
+    """Запрос FTS5 из пользовательского текста: все слова, каждое как префикс"""
+    words = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{word}"*' for word in words[:10])
+
+
+async def search_posts(text: str, page: int = 0, limit: int = POSTS_PAGE_SIZE):
+    """Поиск постов по заголовку и описанию (BM25, заголовок важнее).
+
+    Возвращает (rows, has_next), rows — список (id, title).
+    """
+    query = _fts_query(text)
+    if not query:
+        return [], False
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT rowid, title FROM posts_fts WHERE posts_fts MATCH ? "
+            "ORDER BY bm25(posts_fts, 10.0, 1.0) LIMIT ? OFFSET ?",
+            (query, limit + 1, page * limit)
+        )
+        rows = await cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
 async def get_post(post_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with reading() as db:
         cursor = await db.execute(
             "SELECT id, title, description, media_type, media_file_id, category_id, subcategory_id, views FROM posts WHERE id = ?",
             (post_id,)
         )
-        return await cursor.fetchone()
+        post = await cursor.fetchone()
+    # Учитываем просмотры, ещё не сброшенные из буфера
+    if post and _pending_views[post_id]:
+        post = post[:-1] + (post[-1] + _pending_views[post_id],)
+    return post
 
 
 async def add_post(title: str, description: str, media_type: str, media_file_id: str,
                    category_id: int, subcategory_id: int = None):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         cursor = await db.execute('''
             INSERT INTO posts (title, description, media_type, media_file_id, category_id, subcategory_id)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (title, description, media_type, media_file_id, category_id, subcategory_id))
-        await db.commit()
         return cursor.lastrowid
 
 
 async def update_post(post_id: int, title: str, description: str, media_type: str = None,
                       media_file_id: str = None, category_id: int = None, subcategory_id: int = None):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         if media_type and media_file_id:
             await db.execute('''
                 UPDATE posts SET title = ?, description = ?, media_type = ?, media_file_id = ?,
@@ -302,91 +1454,310 @@ async def update_post(post_id: int, title: str, description: str, media_type: st
             await db.execute('''
                 UPDATE posts SET title = ?, description = ?, category_id = ?, subcategory_id = ? WHERE id = ?
             ''', (title, description, category_id, subcategory_id, post_id))
-        await db.commit()
 
 
 async def delete_post(post_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-        await db.commit()
 
 
 async def increment_post_views(post_id: int, user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE posts SET views = views + 1 WHERE id = ?", (post_id,))
-        await db.execute(
-            "INSERT INTO post_views (post_id, user_id) VALUES (?, ?)",
-            (post_id, user_id)
-        )
-        await db.commit()
-
-
-async def get_posts_count():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM posts")
-        result = await cursor.fetchone()
-        return result[0] if result else 0
-
-
-async def get_total_views():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT SUM(views) FROM posts")
-        result = await cursor.fetchone()
-        return result[0] if result and result[0] else 0
+    """Учёт просмотра: событие попадает в буфер и пишется в базу пачкой"""
+    _pending_views[post_id] += 1
+    _buffer_event(_view_events, (post_id, user_id, _utc_timestamp()))
 
 
 # ========== Марафоны ==========
 async def get_marathons():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT id, name, url, emoji, clicks FROM marathons")
-        return await cursor.fetchall()
+    return list((await _get_catalog())["marathons"].values())
 
 
 async def get_marathon(marathon_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, name, url, emoji, clicks FROM marathons WHERE id = ?", (marathon_id,)
-        )
-        return await cursor.fetchone()
+    return (await _get_catalog())["marathons"].get(marathon_id)
 
 
 async def add_marathon(name: str, url: str, emoji: str = "➡️"):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "INSERT INTO marathons (name, url, emoji) VALUES (?, ?, ?)",
             (name, url, emoji)
         )
-        await db.commit()
+    invalidate_catalog()
 
 
 async def update_marathon(marathon_id: int, name: str, url: str, emoji: str):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute(
             "UPDATE marathons SET name = ?, url = ?, emoji = ? WHERE id = ?",
             (name, url, emoji, marathon_id)
         )
-        await db.commit()
+    invalidate_catalog()
 
 
 async def delete_marathon(marathon_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with writing() as db:
         await db.execute("DELETE FROM marathons WHERE id = ?", (marathon_id,))
-        await db.commit()
+    invalidate_catalog()
 
 
 async def increment_marathon_clicks(marathon_id: int, user_id: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE marathons SET clicks = clicks + 1 WHERE id = ?", (marathon_id,))
-        await db.execute(
-            "INSERT INTO marathon_clicks (marathon_id, user_id) VALUES (?, ?)",
-            (marathon_id, user_id)
+    """Учёт клика: событие попадает в буфер и пишется в базу пачкой"""
+    _pending_clicks[marathon_id] += 1
+    _buffer_event(_click_events, (marathon_id, user_id, _utc_timestamp()))
+
+    # Счётчик в кэше обновляем сразу, без перечитывания справочников
+    if _catalog is not None and marathon_id in _catalog["marathons"]:
+        marathon = _catalog["marathons"][marathon_id]
+        _catalog["marathons"][marathon_id] = marathon[:-1] + (marathon[-1] + 1,)
+
+
+# ========== Рассылки ==========
+async def create_broadcast_job(post_id: int, status_chat_id: int = None, status_message_id: int = None,
+                               schedule_id: int = None):
+    """Новое задание рассылки; schedule_id — запланированная публикация, к которой оно привязывается
+    в той же транзакции (иначе после сбоя осталось бы задание без публикации)"""
+    async with writing() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcast_jobs (post_id, status_chat_id, status_message_id) VALUES (?, ?, ?)",
+            (post_id, status_chat_id, status_message_id)
+        )
+        job_id = cursor.lastrowid
+        if schedule_id is not None:
+            await db.execute("UPDATE scheduled_posts SET job_id = ? WHERE id = ?", (job_id, schedule_id))
+        return job_id
+
+
+async def get_broadcast_job(job_id: int):
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT id, post_id, status, status_chat_id, status_message_id, sent_count, failed_count "
+            "FROM broadcast_jobs WHERE id = ?",
+            (job_id,)
+        )
+        return await cursor.fetchone()
+
+
+async def set_broadcast_job_status(job_id: int, status: str):
+    """running — выполняется или продолжится после перезапуска, paused — ждёт тихих часов"""
+    async with writing() as db:
+        await db.execute("UPDATE broadcast_jobs SET status = ? WHERE id = ?", (status, job_id))
+
+
+async def get_unfinished_broadcast_jobs():
+    async with reading() as db:
+        cursor = await db.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+# Категория поста вычисляется один раз (подзапрос не зависит от u), отписка ищется по первичному ключу
+_RECIPIENTS_FILTER = '''
+    u.notifications_enabled = 1
+    AND u.status = 'active'
+    AND NOT EXISTS (
+        SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = :job_id AND d.user_id = u.user_id
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM user_category_subscriptions s
+        WHERE s.user_id = u.user_id AND s.subscribed = 0 AND s.category_id = (
+            SELECT p.category_id FROM broadcast_jobs j JOIN posts p ON p.id = j.post_id WHERE j.id = :job_id
         )
-        await db.commit()
+    )
+'''
+
+
+async def iter_broadcast_recipients(job_id: int, chunk_size: int = USER_CHUNK_SIZE):
+    """Подписанные на категорию поста пользователи, ещё не получившие рассылку job_id.
+
+    Выборка идёт порциями по ключу user_id (keyset), соединение не удерживается
+    между порциями, поэтому память не зависит от числа пользователей.
+    """
+    last_user_id = None
+    while True:
+        async with reading() as db:
+            if last_user_id is None:
+                cursor = await db.execute(
+                    f"SELECT u.user_id FROM users u WHERE {_RECIPIENTS_FILTER} ORDER BY u.user_id LIMIT :limit",
+                    {"job_id": job_id, "limit": chunk_size}
+                )
+            else:
+                cursor = await db.execute(
+                    f"SELECT u.user_id FROM users u WHERE {_RECIPIENTS_FILTER} AND u.user_id > :after "
+                    "ORDER BY u.user_id LIMIT :limit",
+                    {"job_id": job_id, "after": last_user_id, "limit": chunk_size}
+                )
+            rows = await cursor.fetchall()
 
+        for (user_id,) in rows:
+            yield user_id
+        if len(rows) < chunk_size:
+            return
+        last_user_id = rows[-1][0]
 
-async def get_total_clicks():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT SUM(clicks) FROM marathons")
+
+async def count_broadcast_recipients(job_id: int):
+    async with reading() as db:
+        cursor = await db.execute(f"SELECT COUNT(*) FROM users u WHERE {_RECIPIENTS_FILTER}", {"job_id": job_id})
         result = await cursor.fetchone()
-        return result[0] if result and result[0] else 0
+        return result[0] if result else 0
+
+
+async def mark_deliveries(job_id: int, results: list):
+    """Отметка пачки получателей: results — список (user_id, результат доставки).
+
+    Пользователи, заблокировавшие бота или с ненайденным чатом, получают
+    этот статус и больше не попадают в рассылки.
+    """
+    if not results:
+        return
+    sent = sum(1 for _, status in results if status == "sent")
+    unreachable = [(status, user_id) for user_id, status in results if status in UNREACHABLE_STATUSES]
+    async with writing() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, ?)",
+            [(job_id, user_id, status) for user_id, status in results]
+        )
+        if unreachable:
+            await db.executemany("UPDATE users SET status = ? WHERE user_id = ?", unreachable)
+        await db.execute(
+            "UPDATE broadcast_jobs SET sent_count = sent_count + ?, failed_count = failed_count + ? WHERE id = ?",
+            (sent, len(results) - sent, job_id)
+        )
+    # Вернувшийся недоступный пользователь при /start снова станет активным
+    for _, user_id in unreachable:
+        _known_users.pop(user_id, None)
+        _user_settings.pop(user_id, None)
+
+
+async def finish_broadcast_job(job_id: int, status: str = "done"):
+    """Завершение задания (done или failed); запланированная публикация получает тот же статус"""
+    async with writing() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, job_id)
+        )
+        await db.execute(
+            "UPDATE scheduled_posts SET status = ? WHERE job_id = ? AND status = 'started'",
+            (status, job_id)
+        )
+
+
+# ========== Отложенные публикации ==========
+# pending — ждёт времени, started — рассылка запущена, done или failed — рассылка завершена
+# (статус выставляет finish_broadcast_job, в том числе для рассылки, продолженной после перезапуска)
+async def schedule_post(post_id: int, scheduled_at: float, offpeak: bool = False, status_chat_id: int = None):
+    async with writing() as db:
+        cursor = await db.execute(
+            "INSERT INTO scheduled_posts (post_id, scheduled_at, offpeak, status_chat_id) VALUES (?, ?, ?, ?)",
+            (post_id, scheduled_at, int(offpeak), status_chat_id)
+        )
+        return cursor.lastrowid
+
+
+async def get_pending_schedule_times():
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT scheduled_at FROM scheduled_posts WHERE status = 'pending' ORDER BY scheduled_at"
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def claim_due_scheduled_posts(now: float):
+    """Перевод наступивших публикаций в started; возвращает (id, post_id, job_id, offpeak, status_chat_id)"""
+    async with writing() as db:
+        cursor = await db.execute(
+            """
+            UPDATE scheduled_posts SET status = 'started'
+            WHERE status = 'pending' AND scheduled_at <= ?
+            RETURNING id, post_id, job_id, offpeak, status_chat_id
+            """,
+            (now,)
+        )
+        return await cursor.fetchall()
+
+
+async def reschedule_post(schedule_id: int, scheduled_at: float):
+    """Продолжение публикации в следующее окно: задание рассылки ставится на паузу"""
+    async with writing() as db:
+        await db.execute(
+            "UPDATE scheduled_posts SET status = 'pending', scheduled_at = ? WHERE id = ?",
+            (scheduled_at, schedule_id)
+        )
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = 'paused' "
+            "WHERE id = (SELECT job_id FROM scheduled_posts WHERE id = ?) AND status = 'running'",
+            (schedule_id,)
+        )
+
+
+async def recover_scheduled_posts():
+    """Публикации, прерванные перезапуском: рассылки в тихие часы возвращаются планировщику,
+    а не продолжаются сразу; не успевшие создать задание снова ждут запуска;
+    публикации с уже завершённой рассылкой закрываются"""
+    async with writing() as db:
+        # Публикации, чья рассылка уже завершилась, получают её итоговый статус
+        await db.execute(
+            "UPDATE scheduled_posts SET status = ("
+            "SELECT status FROM broadcast_jobs WHERE id = scheduled_posts.job_id) "
+            "WHERE status = 'started' AND job_id IN ("
+            "SELECT id FROM broadcast_jobs WHERE status IN ('done', 'failed'))"
+        )
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = 'paused' WHERE status = 'running' AND id IN ("
+            "SELECT job_id FROM scheduled_posts WHERE status = 'started' AND offpeak = 1)"
+        )
+        await db.execute(
+            "UPDATE scheduled_posts SET status = 'pending' "
+            "WHERE status = 'started' AND (offpeak = 1 OR job_id IS NULL)"
+        )
+
+
+# ========== Состояния FSM ==========
+# Просроченная запись считается пустой: при записи её состояние и данные сбрасываются
+async def get_fsm_record(key: str, now: float):
+    """(state, data) для ключа или None, если записи нет или она просрочена"""
+    async with reading() as db:
+        cursor = await db.execute(
+            "SELECT state, data FROM fsm_records WHERE key = ? AND expires_at > ?",
+            (key, now)
+        )
+        return await cursor.fetchone()
+
+
+async def set_fsm_state(key: str, state, now: float, expires_at: float):
+    async with writing() as db:
+        await db.execute(
+            """
+            INSERT INTO fsm_records (key, state, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                state = excluded.state,
+                data = CASE WHEN fsm_records.expires_at > ? THEN fsm_records.data ELSE '{}' END,
+                expires_at = excluded.expires_at
+            """,
+            (key, state, expires_at, now)
+        )
+
+
+async def set_fsm_data(key: str, data: str, now: float, expires_at: float):
+    async with writing() as db:
+        await db.execute(
+            """
+            INSERT INTO fsm_records (key, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                state = CASE WHEN fsm_records.expires_at > ? THEN fsm_records.state END,
+                data = excluded.data,
+                expires_at = excluded.expires_at
+            """,
+            (key, data, expires_at, now)
+        )
+
+
+async def delete_expired_fsm_records(now: float):
+    async with writing() as db:
+        cursor = await db.execute("DELETE FROM fsm_records WHERE expires_at <= ?", (now,))
+        return cursor.rowcount
+
 
+# Время каждой публичной функции модуля попадает в метрику DB_CALL_DURATION
+for _name, _func in list(globals().items()):
+    if not _name.startswith("_") and inspect.iscoroutinefunction(_func) and _func.__module__ == __name__:
+        globals()[_name] = metrics.timed(DB_CALL_DURATION, _name)(_func)
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд живёт незавершённый сценарий (состояние и данные) без изменений
+FSM_TTL = 86400
+CLEANUP_INTERVAL = 600.0
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в базе бота: сценарии переживают перезапуск.
+
+    Запись обновляет срок жизни ключа; просроченные записи не читаются
+    и удаляются фоновой задачей.
+    """
+
+    def __init__(self, ttl: float = FSM_TTL, cleanup_interval: float = CLEANUP_INTERVAL):
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cleanup_task = None
+
+    def start_cleanup(self):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await db.delete_expired_fsm_records(time.time())
+                if removed:
+                    logger.info(f"Removed {removed} expired FSM records")
+            except Exception:
+                logger.exception("FSM storage cleanup failed")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await db.set_fsm_state(self.key_builder.build(key), state, time.time(), time.time() + self.ttl)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = await db.get_fsm_record(self.key_builder.build(key), time.time())
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await db.set_fsm_data(
+            self.key_builder.build(key), json.dumps(dict(data), ensure_ascii=False),
+            time.time(), time.time() + self.ttl
+        )
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = await db.get_fsm_record(self.key_builder.build(key), time.time())
+        return json.loads(record[1]) if record else {}
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+            self._cleanup_task = None
+
+
+def create_storage(kind: str = "memory", ttl: float = FSM_TTL, redis_url: str = None):
+    """Хранилище FSM по настройке FSM_STORAGE: memory, sqlite или redis"""
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "sqlite":
+        return SQLiteStorage(ttl)
+    if kind == "redis":
+        if not redis_url:
+            raise ValueError("REDIS_URL is required for FSM_STORAGE=redis")
+        # Пакет redis (requirements.txt) импортируется только в этом режиме
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(
+            redis_url,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=int(ttl),
+            data_ttl=int(ttl),
+        )
+    raise ValueError(f"Unknown FSM storage: {kind!r} (expected memory, sqlite or redis)")
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит исходящих сообщений и лимит на один чат (с небольшим запасом для навигации)
+GLOBAL_RATE = 28.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+MAX_RETRIES = 3
+# Одновременных соединений aiohttp с Bot API
+CONNECTIONS = 100
+# Сколько чатов помнить, прежде чем чистить полностью восстановившиеся лимиты
+CHAT_LIMITS_PRUNE = 10000
+
+# Методы, повтор которых после таймаута может продублировать сообщение
+NON_IDEMPOTENT_PREFIXES = ("send", "copy", "forward")
+
+# Полосы приоритета: ответы пользователям идут раньше рассылок
+INTERACTIVE = 0
+BROADCAST = 1
+LANES = ("interactive", "broadcast")
+lane = ContextVar("outbound_lane", default=INTERACTIVE)
+
+API_WAIT = metrics.Histogram(
+    "bot_api_wait_seconds", "Time outbound Bot API calls wait for a rate-limit slot", ["lane"]
+)
+API_DURATION = metrics.Histogram(
+    "bot_api_request_duration_seconds", "Duration of Bot API calls including retries", ["lane"]
+)
+API_RETRIES = metrics.Counter("bot_api_retries_total", "Retried Bot API calls", ["reason"])
+
+
+class _Bucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def pause_until(self, moment: float):
+        """Не копить токены до moment: после паузы отправки идут с обычной скоростью, без всплеска"""
+        self.tokens = 0.0
+        self.updated_at = max(self.updated_at, moment)
+
+    def delay(self):
+        """Сколько ждать до следующего токена (0 — можно сейчас)"""
+        self.refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class OutboundGateway(BaseRequestMiddleware):
+    """Middleware сессии бота: все исходящие вызовы Bot API проходят через него.
+
+    Вызовы с chat_id (отправка и редактирование сообщений) ограничиваются
+    общим лимитом и лимитом на чат; свободный слот общего лимита получает
+    ожидающий вызов из самой приоритетной полосы. RetryAfter приостанавливает
+    весь исходящий поток и повторяется; сетевые ошибки и 5xx повторяются с
+    экспоненциальной задержкой и случайным разбросом, но только для
+    идемпотентных методов: отправку по таймауту Telegram мог уже принять.
+    Вызовы полосы рассылок не повторяются здесь вовсе — это делает движок
+    рассылки, иначе повторы двух уровней перемножаются.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: int = CHAT_BURST, max_retries: int = MAX_RETRIES):
+        self.bucket = _Bucket(rate, max(1.0, rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self._chats = {}
+        self._queues = tuple(deque() for _ in LANES)
+        self._has_waiters = None
+        self._pump_task = None
+
+    def queue_depth(self, lane_value: int = None):
+        if lane_value is None:
+            return sum(len(queue) for queue in self._queues)
+        return len(self._queues[lane_value])
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # Служебные вызовы (getUpdates, answerCallbackQuery и т.п.) не ограничиваются
+            return await make_request(bot, method)
+
+        current_lane = lane.get()
+        max_retries = 0 if current_lane == BROADCAST else self.max_retries
+        idempotent = not method.__api_method__.startswith(NON_IDEMPOTENT_PREFIXES)
+        started_at = time.monotonic()
+        try:
+            for attempt in range(max_retries + 1):
+                await self._acquire(chat_id, current_lane)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    # Пауза нужна всем полосам, даже если повторять будет вызывающий
+                    self.pause(e.retry_after + random.uniform(0, 1))
+                    if attempt == max_retries:
+                        raise
+                    API_RETRIES.labels("retry_after").inc()
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    if attempt == max_retries or not idempotent:
+                        raise
+                    API_RETRIES.labels(type(e).__name__).inc()
+                    await asyncio.sleep(2 ** attempt * random.uniform(0.5, 1.5))
+        finally:
+            API_DURATION.labels(LANES[current_lane]).observe(time.monotonic() - started_at)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.bucket.pause_until(self.paused_until)
+        logger.warning(f"Outbound Bot API calls paused for {seconds:.1f}s")
+
+    async def _acquire(self, chat_id, lane_value: int):
+        queued_at = time.monotonic()
+
+        # Лимит на чат: ждём свою очередь, не занимая общий слот
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= CHAT_LIMITS_PRUNE:
+                self._prune_chats()
+            chat = self._chats[chat_id] = _Bucket(self.chat_rate, self.chat_burst)
+        while (delay := chat.delay()) > 0:
+            await asyncio.sleep(delay)
+        chat.tokens -= 1
+
+        # Общий лимит: слот выдаёт _pump по приоритету полос
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[lane_value].append(waiter)
+        self._start_pump()
+        self._has_waiters.set()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self._queues[lane_value]:
+                self._queues[lane_value].remove(waiter)
+            raise
+        API_WAIT.labels(LANES[lane_value]).observe(time.monotonic() - queued_at)
+
+    def _prune_chats(self):
+        # Полностью восстановившийся лимит ничем не отличается от нового
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+
+    def _start_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._has_waiters = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while True:
+            if not any(self._queues):
+                self._has_waiters.clear()
+                await self._has_waiters.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            delay = self.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            waiter = self._next_waiter()
+            if waiter is not None:
+                waiter.set_result(None)
+                self.bucket.tokens -= 1
+
+    def _next_waiter(self):
+        """Первый ожидающий из самой приоритетной непустой полосы"""
+        for queue in self._queues:
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    return waiter
+        return None
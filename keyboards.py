@@ -1,7 +1,48 @@
+from functools import cache, wraps
+
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+import database as db
+
+# Клавиатуры по данным справочников: ключ — содержимое, сброс при смене версии справочников
+CATALOG_MARKUPS_LIMIT = 512
+_catalog_markups = {}
+_catalog_markups_version = None
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _catalog_cached(key=None):
+    """Кэширование клавиатуры, построенной по категориям, подкатегориям или марафонам"""
+    def decorator(build):
+        @wraps(build)
+        def keyboard(*args, **kwargs):
+            global _catalog_markups_version
+            version = db.catalog_version()
+            if version != _catalog_markups_version or len(_catalog_markups) >= CATALOG_MARKUPS_LIMIT:
+                _catalog_markups.clear()
+                _catalog_markups_version = version
+
+            cache_key = (build.__name__, key(*args, **kwargs) if key else _freeze((args, tuple(sorted(kwargs.items())))))
+            markup = _catalog_markups.get(cache_key)
+            if markup is None:
+                markup = _catalog_markups[cache_key] = build(*args, **kwargs)
+            return markup
+        return keyboard
+    return decorator
 
+
+def _marathons_key(marathons: list, *args, **kwargs):
+    # Счётчик кликов на кнопки не влияет — в ключ не входит
+    return tuple((m_id, name, emoji) for m_id, name, url, emoji, clicks in marathons), args, tuple(kwargs.items())
+
+
+@cache
 def main_menu_keyboard(is_admin: bool = False):
     """Главное меню (inline)"""
     builder = InlineKeyboardBuilder()
@@ -12,11 +53,13 @@ def main_menu_keyboard(is_admin: bool = False):
     )
     builder.row(InlineKeyboardButton(text="🛍 Каталог товаров", callback_data="menu_catalog"))
     builder.row(InlineKeyboardButton(text="🔗 Важные ссылки", callback_data="menu_links"))
+    builder.row(InlineKeyboardButton(text="🔔 Подписки", callback_data="menu_subscriptions"))
     if is_admin:
         builder.row(InlineKeyboardButton(text="⚙️ Админка", callback_data="menu_admin"))
     return builder.as_markup()
 
 
+@cache
 def catalog_keyboard():
     """Каталог товаров"""
     builder = InlineKeyboardBuilder()
@@ -44,6 +87,7 @@ def catalog_keyboard():
     return builder.as_markup()
 
 
+@cache
 def important_links_keyboard():
     """Важные ссылки"""
     builder = InlineKeyboardBuilder()
@@ -55,6 +99,7 @@ def important_links_keyboard():
     return builder.as_markup()
 
 
+@cache
 def admin_menu_keyboard():
     """Админ-панель (inline)"""
     builder = InlineKeyboardBuilder()
@@ -70,6 +115,7 @@ def admin_menu_keyboard():
     return builder.as_markup()
 
 
+@cache
 def posts_management_keyboard():
     """Управление постами (inline)"""
     builder = InlineKeyboardBuilder()
@@ -85,6 +131,7 @@ def posts_management_keyboard():
     return builder.as_markup()
 
 
+@cache
 def marathons_management_keyboard():
     """Управление марафонами (inline)"""
     builder = InlineKeyboardBuilder()
@@ -96,17 +143,31 @@ def marathons_management_keyboard():
     return builder.as_markup()
 
 
+@cache
 def settings_keyboard(notifications_on: bool = True):
     """Настройки (inline)"""
     builder = InlineKeyboardBuilder()
     notif_text = "🔔 Уведомления: ВКЛ" if notifications_on else "🔕 Уведомления: ВЫКЛ"
     builder.row(InlineKeyboardButton(text=notif_text, callback_data="toggle_notifications"))
+    builder.row(InlineKeyboardButton(text="📂 Подписки на категории", callback_data="menu_subscriptions"))
     builder.row(InlineKeyboardButton(text="🔙 В админку", callback_data="menu_admin"))
     return builder.as_markup()
 
 
+@_catalog_cached()
+def subscriptions_keyboard(categories: list, unsubscribed: frozenset, notifications_on: bool = True):
+    """Подписки пользователя: уведомления и категории рассылок"""
+    builder = InlineKeyboardBuilder()
+    notif_text = "🔔 Все уведомления: ВКЛ" if notifications_on else "🔕 Все уведомления: ВЫКЛ"
+    builder.row(InlineKeyboardButton(text=notif_text, callback_data="sub_notifications"))
+    for cat_id, name, emoji in categories:
+        mark = "❌" if cat_id in unsubscribed else "✅"
+        builder.row(InlineKeyboardButton(text=f"{mark} {emoji} {name}", callback_data=f"sub_cat_{cat_id}"))
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main"))
+    return builder.as_markup()
 
 
+@cache
 def yes_no_keyboard():
     """Да/Нет"""
     builder = InlineKeyboardBuilder()
@@ -117,6 +178,7 @@ def yes_no_keyboard():
     return builder.as_markup()
 
 
+@cache
 def broadcast_keyboard():
     """Рассылка при добавлении поста"""
     builder = InlineKeyboardBuilder()
@@ -124,11 +186,25 @@ def broadcast_keyboard():
         InlineKeyboardButton(text="📢 Разослать всем", callback_data="broadcast_yes"),
         InlineKeyboardButton(text="❌ Не рассылать", callback_data="broadcast_no")
     )
+    builder.row(InlineKeyboardButton(text="⏰ Запланировать", callback_data="broadcast_schedule"))
+    return builder.as_markup()
+
+
+@cache
+def schedule_keyboard(offpeak_hours: tuple):
+    """Выбор времени отложенной рассылки"""
+    start, end = offpeak_hours
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(
+        text=f"🌙 В тихие часы ({start:02d}:00–{end:02d}:00)", callback_data="schedule_offpeak"
+    ))
+    builder.row(InlineKeyboardButton(text="❌ Не рассылать", callback_data="broadcast_no"))
     return builder.as_markup()
 
 
 # ========== Inline клавиатуры ==========
 
+@_catalog_cached()
 def categories_inline_keyboard(categories: list, prefix: str = "cat"):
     """Клавиатура с категориями"""
     builder = InlineKeyboardBuilder()
@@ -141,6 +217,7 @@ def categories_inline_keyboard(categories: list, prefix: str = "cat"):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def subcategories_inline_keyboard(subcategories: list, category_id: int, prefix: str = "subcat"):
     """Клавиатура с подкатегориями"""
     builder = InlineKeyboardBuilder()
@@ -153,7 +230,22 @@ def subcategories_inline_keyboard(subcategories: list, category_id: int, prefix:
     return builder.as_markup()
 
 
-def posts_inline_keyboard(posts: list, back_callback: str = "back_to_subcategories"):
+def _page_navigation(builder: InlineKeyboardBuilder, posts: list, page_prefix: str,
+                     has_prev: bool, has_next: bool):
+    """Кнопки листания: в callback_data — id первого/последнего поста страницы"""
+    if not page_prefix or not posts:
+        return
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"{page_prefix}_p_{posts[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"{page_prefix}_n_{posts[-1][0]}"))
+    if buttons:
+        builder.row(*buttons)
+
+
+def posts_inline_keyboard(posts: list, back_callback: str = "back_to_subcategories",
+                          page_prefix: str = None, has_prev: bool = False, has_next: bool = False):
     """Клавиатура с постами"""
     builder = InlineKeyboardBuilder()
     for post_id, title, *_ in posts:
@@ -161,10 +253,27 @@ def posts_inline_keyboard(posts: list, back_callback: str = "back_to_subcategori
             text=title[:50],
             callback_data=f"post_{post_id}"
         ))
+    _page_navigation(builder, posts, page_prefix, has_prev, has_next)
     builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data=back_callback))
     return builder.as_markup()
 
 
+def search_results_keyboard(posts: list, page: int, has_next: bool):
+    """Результаты поиска с листанием"""
+    builder = InlineKeyboardBuilder()
+    for post_id, title in posts:
+        builder.row(InlineKeyboardButton(text=title[:50], callback_data=f"post_{post_id}"))
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"search_{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"search_{page + 1}"))
+    if buttons:
+        builder.row(*buttons)
+    builder.row(InlineKeyboardButton(text="🔙 В главное меню", callback_data="back_to_main"))
+    return builder.as_markup()
+
+
 def post_actions_keyboard(post_id: int, back_callback: str = "back_to_posts"):
     """Действия с постом (для админа)"""
     builder = InlineKeyboardBuilder()
@@ -176,6 +285,7 @@ def post_actions_keyboard(post_id: int, back_callback: str = "back_to_posts"):
     return builder.as_markup()
 
 
+@_catalog_cached(_marathons_key)
 def marathons_inline_keyboard(marathons: list, is_admin: bool = False):
     """Клавиатура с марафонами"""
     builder = InlineKeyboardBuilder()
@@ -188,6 +298,7 @@ def marathons_inline_keyboard(marathons: list, is_admin: bool = False):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def marathon_link_keyboard(marathon_id: int, url: str):
     """Кнопка для перехода по ссылке марафона"""
     builder = InlineKeyboardBuilder()
@@ -207,6 +318,7 @@ def marathon_actions_keyboard(marathon_id: int):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def admin_categories_keyboard(categories: list):
     """Категории для админа"""
     builder = InlineKeyboardBuilder()
@@ -220,6 +332,7 @@ def admin_categories_keyboard(categories: list):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def admin_subcategories_keyboard(subcategories: list, category_id: int):
     """Подкатегории для админа"""
     builder = InlineKeyboardBuilder()
@@ -233,7 +346,7 @@ def admin_subcategories_keyboard(subcategories: list, category_id: int):
     return builder.as_markup()
 
 
-def admin_posts_keyboard(posts: list):
+def admin_posts_keyboard(posts: list, page_prefix: str = None, has_prev: bool = False, has_next: bool = False):
     """Посты для админа"""
     builder = InlineKeyboardBuilder()
     for post_id, title, *_ in posts:
@@ -241,10 +354,12 @@ def admin_posts_keyboard(posts: list):
             InlineKeyboardButton(text=title[:40], callback_data=f"admin_post_{post_id}"),
             InlineKeyboardButton(text="🗑", callback_data=f"del_post_{post_id}")
         )
+    _page_navigation(builder, posts, page_prefix, has_prev, has_next)
     builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_posts_menu"))
     return builder.as_markup()
 
 
+@_catalog_cached(_marathons_key)
 def admin_marathons_keyboard(marathons: list):
     """Марафоны для админа"""
     builder = InlineKeyboardBuilder()
@@ -257,6 +372,7 @@ def admin_marathons_keyboard(marathons: list):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def select_category_keyboard(categories: list, prefix: str = "select_cat"):
     """Выбор категории"""
     builder = InlineKeyboardBuilder()
@@ -269,6 +385,7 @@ def select_category_keyboard(categories: list, prefix: str = "select_cat"):
     return builder.as_markup()
 
 
+@_catalog_cached()
 def select_subcategory_keyboard(subcategories: list, prefix: str = "select_subcat"):
     """Выбор подкатегории"""
     builder = InlineKeyboardBuilder()
@@ -281,3 +398,15 @@ def select_subcategory_keyboard(subcategories: list, prefix: str = "select_subca
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_action"))
     return builder.as_markup()
 
+
+# Статические клавиатуры строим один раз при импорте
+for _flag in (False, True):
+    main_menu_keyboard(_flag)
+    settings_keyboard(_flag)
+catalog_keyboard()
+important_links_keyboard()
+admin_menu_keyboard()
+posts_management_keyboard()
+marathons_management_keyboard()
+yes_no_keyboard()
+broadcast_keyboard()
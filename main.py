@@ -1,34 +1,133 @@
 import asyncio
+import html
 import logging
 import os
 import random
+import secrets
+import signal
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from aiohttp import web
 
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
+import broadcast
 import database as db
+import fsm_storage
+import gateway
 import keyboards as kb
+import metrics
+import scheduler
+from middlewares import (
+    UPDATE_CONCURRENCY as DEFAULT_UPDATE_CONCURRENCY, HandlerMetrics, UpdateScheduler, setup_update_scheduler
+)
 
 # Загрузка переменных окружения
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMINS = [int(x) for x in os.getenv("ADMINS", "").split(",") if x.strip()]
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", db.READ_POOL_SIZE))
+
+# Рассылка: скорость (сообщений в секунду) и число параллельных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", broadcast.GLOBAL_RATE))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", broadcast.CONCURRENCY))
+
+# Отложенная запись просмотров и кликов
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", db.EVENT_FLUSH_INTERVAL))
+EVENT_FLUSH_SIZE = int(os.getenv("EVENT_FLUSH_SIZE", db.EVENT_FLUSH_SIZE))
+
+# Как часто обновлять сводки статистики, секунды
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", db.ROLLUP_INTERVAL))
+
+# Хранение сырых событий (дней, 0 — хранить всё) и каталог для архива перед удалением
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", db.EVENT_RETENTION_DAYS))
+EVENT_ARCHIVE_DIR = os.getenv("EVENT_ARCHIVE_DIR") or None
+
+# Хранилище состояний FSM: memory, sqlite (переживает перезапуск) или redis (общее для нескольких копий бота)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_TTL = float(os.getenv("FSM_TTL", fsm_storage.FSM_TTL))
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Получение апдейтов: polling или webhook (адрес WEBHOOK_URL + WEBHOOK_PATH на встроенном веб-сервере)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя — по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", DEFAULT_UPDATE_CONCURRENCY))
+
+# Пороги /ready: время ответа базы, задержка event loop (секунды) и очередь апдейтов
+READY_DB_TIMEOUT = float(os.getenv("READY_DB_TIMEOUT", 1.0))
+READY_LOOP_LAG = float(os.getenv("READY_LOOP_LAG", 0.5))
+READY_MAX_BACKLOG = int(os.getenv("READY_MAX_BACKLOG", UPDATE_CONCURRENCY * 4))
+
+# Отложенные рассылки: часовой пояс админки и тихие часы («10-12», конец может быть после полуночи)
+TIMEZONE = os.getenv("TIMEZONE", scheduler.TIMEZONE)
+OFFPEAK_HOURS = tuple(int(h) for h in os.getenv("OFFPEAK_HOURS", "%d-%d" % scheduler.OFFPEAK_HOURS).split("-"))
+
+# Исходящие вызовы Bot API: общий лимит и лимит на чат (в секунду), всплеск на чат, соединения
+API_RATE = float(os.getenv("API_RATE", gateway.GLOBAL_RATE))
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", gateway.CHAT_RATE))
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", gateway.CHAT_BURST))
+API_CONNECTIONS = int(os.getenv("API_CONNECTIONS", gateway.CONNECTIONS))
+
+# Сколько секунд даётся на завершение обработки при остановке (SIGTERM)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+LOOP_LAG_INTERVAL = 0.5
+
+# Настройки хранилища SQLite
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", db.DEFAULT_PRAGMAS["journal_mode"]),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", db.DEFAULT_PRAGMAS["synchronous"]),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", db.DEFAULT_PRAGMAS["cache_size"])),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", db.DEFAULT_PRAGMAS["mmap_size"])),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", db.DEFAULT_PRAGMAS["busy_timeout"])),
+}
+# Разовый полный VACUUM при старте для перевода старой базы в incremental auto_vacuum
+SQLITE_VACUUM_ON_START = os.getenv("SQLITE_VACUUM_ON_START", "").lower() in ("1", "true", "yes")
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Все исходящие вызовы идут через одну сессию с общими лимитами и приоритетом ответов пользователям
+session = AiohttpSession(limit=API_CONNECTIONS)
+outbound = gateway.OutboundGateway(API_RATE, API_CHAT_RATE, API_CHAT_BURST)
+session.middleware(outbound)
+bot = Bot(token=BOT_TOKEN, session=session)
+storage = fsm_storage.create_storage(FSM_STORAGE, FSM_TTL, REDIS_URL)
+# С общим хранилищем апдейты одного пользователя не обрабатываются разными копиями одновременно
+dp = Dispatcher(
+    storage=storage,
+    events_isolation=storage.create_isolation() if FSM_STORAGE == "redis" else None,
+)
 router = Router()
 dp.include_router(router)
+update_scheduler = UpdateScheduler(UPDATE_CONCURRENCY)
+setup_update_scheduler(dp, update_scheduler)
+router.message.middleware(HandlerMetrics())
+router.callback_query.middleware(HandlerMetrics())
+
+# Метрики, снимаемые в момент запроса /metrics
+metrics.Gauge("bot_pending_events", "View and click events waiting to be written", function=db.pending_events_count)
+metrics.Gauge("bot_broadcast_jobs_running", "Running broadcast jobs", function=lambda: len(broadcast_tasks))
+metrics.Gauge("bot_updates_active", "Updates being handled", function=lambda: update_scheduler.active)
+metrics.Gauge("bot_updates_waiting", "Updates waiting for a handler slot", function=lambda: update_scheduler.waiting)
+metrics.Gauge("bot_update_chats_queued", "Chats with updates in progress or queued",
+              function=lambda: update_scheduler.chats_queued)
+metrics.Gauge("bot_api_queue_depth", "Bot API calls waiting for a rate-limit slot", function=outbound.queue_depth)
 
 # Сообщения для рассылки по категориям
 BROADCAST_MESSAGES = {
@@ -64,6 +163,7 @@ class AddPostStates(StatesGroup):
     waiting_for_category = State()
     waiting_for_subcategory = State()
     waiting_for_broadcast = State()
+    waiting_for_publish_time = State()
 
 
 class EditPostStates(StatesGroup):
@@ -117,10 +217,35 @@ async def send_post_to_user(chat_id: int, post: tuple, category_name: str = None
             await bot.send_video(chat_id, media_file_id, caption=text, parse_mode="HTML")
         else:
             await bot.send_message(chat_id, text, parse_mode="HTML")
-        return True
+        return broadcast.SENT
+    except TelegramRetryAfter:
+        # Обрабатывается движком рассылки: пауза и повторная отправка
+        raise
     except Exception as e:
         logger.error(f"Error sending post to {chat_id}: {e}")
-        return False
+        return broadcast.classify_error(e)
+
+
+async def posts_page(scope: str, ref: int = 0, after_id: int = None, before_id: int = None):
+    """Страница списка постов: c — категория ref, s — подкатегория ref, a — все посты (админка)"""
+    page_prefix = f"pg_{scope}_{ref}"
+
+    if scope == "a":
+        posts, has_prev, has_next = await db.get_post_titles_page(after_id=after_id, before_id=before_id)
+        return posts, kb.admin_posts_keyboard(posts, page_prefix, has_prev, has_next)
+
+    if scope == "s":
+        subcategory = await db.get_subcategory(ref)
+        back_callback = f"back_subcat_{subcategory[2]}" if subcategory else "back_to_main"
+        posts, has_prev, has_next = await db.get_post_titles_page(
+            subcategory_id=ref, after_id=after_id, before_id=before_id
+        )
+    else:
+        back_callback = "back_to_main"
+        posts, has_prev, has_next = await db.get_post_titles_page(
+            category_id=ref, after_id=after_id, before_id=before_id
+        )
+    return posts, kb.posts_inline_keyboard(posts, back_callback, page_prefix, has_prev, has_next)
 
 
 # ========== Основные команды ==========
@@ -151,7 +276,8 @@ async def cmd_help(message: Message):
     text += "📌 <b>Команды:</b>\n"
     text += "/start — главное меню\n"
     text += "/help — помощь\n"
-    text += "/menu — открыть меню"
+    text += "/menu — открыть меню\n"
+    text += "/search <запрос> — поиск по постам"
 
     await message.answer(text, parse_mode="HTML")
 
@@ -162,6 +288,45 @@ async def cmd_menu(message: Message, state: FSMContext):
     await message.answer("📋 Главное меню:", reply_markup=kb.main_menu_keyboard(is_admin(message.from_user.id)))
 
 
+# ========== Поиск ==========
+@router.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject, state: FSMContext):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("🔍 Напишите запрос после команды, например:\n/search питание")
+        return
+
+    await state.update_data(search_query=query)
+    posts, has_next = await db.search_posts(query)
+
+    if not posts:
+        await message.answer(f"🔍 По запросу «{query}» ничего не найдено.")
+        return
+
+    await message.answer(
+        f"🔍 Результаты поиска «{query}»:",
+        reply_markup=kb.search_results_keyboard(posts, 0, has_next)
+    )
+
+
+@router.callback_query(F.data.startswith("search_"))
+async def search_page(callback: CallbackQuery, state: FSMContext):
+    page = int(callback.data.split("_")[1])
+    query = (await state.get_data()).get("search_query")
+
+    if not query:
+        await callback.answer("Повторите поиск: /search <запрос>")
+        return
+
+    posts, has_next = await db.search_posts(query, page)
+    if not posts:
+        await callback.answer("Больше ничего не найдено")
+        return
+
+    await callback.message.edit_reply_markup(reply_markup=kb.search_results_keyboard(posts, page, has_next))
+    await callback.answer()
+
+
 # ========== Категории для пользователей ==========
 @router.callback_query(F.data.in_(["menu_business", "menu_food", "menu_health"]))
 async def show_category(callback: CallbackQuery, state: FSMContext):
@@ -192,11 +357,11 @@ async def show_category(callback: CallbackQuery, state: FSMContext):
         )
     else:
         # Показываем посты напрямую
-        posts = await db.get_posts(category_id=category_id)
+        posts, markup = await posts_page("c", category_id)
         if posts:
             await callback.message.edit_text(
                 f"📂 {category[2]} {category[1]}\n\nВыберите пост:",
-                reply_markup=kb.posts_inline_keyboard(posts, "back_to_main")
+                reply_markup=markup
             )
         else:
             builder = kb.InlineKeyboardBuilder()
@@ -220,12 +385,12 @@ async def show_subcategory_posts(callback: CallbackQuery, state: FSMContext):
 
     await state.update_data(current_subcategory_id=subcategory_id, current_category_id=subcategory[2])
 
-    posts = await db.get_posts(subcategory_id=subcategory_id)
+    posts, markup = await posts_page("s", subcategory_id)
 
     if posts:
         await callback.message.edit_text(
             f"📁 {subcategory[1]}\n\nВыберите пост:",
-            reply_markup=kb.posts_inline_keyboard(posts, f"back_subcat_{subcategory[2]}")
+            reply_markup=markup
         )
     else:
         await callback.message.edit_text(
@@ -236,6 +401,27 @@ async def show_subcategory_posts(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+@router.callback_query(F.data.startswith("pg_"))
+async def show_posts_page(callback: CallbackQuery):
+    # pg_<scope>_<ref>_<n|p>_<id поста на границе страницы>
+    _, scope, ref, direction, cursor = callback.data.split("_")
+    if scope == "a" and not is_admin(callback.from_user.id):
+        return
+
+    cursor = int(cursor)
+    if direction == "n":
+        posts, markup = await posts_page(scope, int(ref), after_id=cursor)
+    else:
+        posts, markup = await posts_page(scope, int(ref), before_id=cursor)
+
+    if not posts:
+        await callback.answer("Постов больше нет")
+        return
+
+    await callback.message.edit_reply_markup(reply_markup=markup)
+    await callback.answer()
+
+
 @router.callback_query(F.data.startswith("back_subcat_"))
 async def back_to_subcategories(callback: CallbackQuery, state: FSMContext):
     category_id = int(callback.data.split("_")[2])
@@ -269,6 +455,51 @@ async def callback_back_to_main(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+# ========== Подписки ==========
+async def subscriptions_markup(user_id: int):
+    settings = await db.get_user_settings(user_id)
+    notifications_on = settings[0] == 1 if settings else True
+    return kb.subscriptions_keyboard(
+        await db.get_categories(), frozenset(await db.get_unsubscribed_categories(user_id)), notifications_on
+    )
+
+
+SUBSCRIPTIONS_TEXT = (
+    "🔔 <b>Подписки</b>\n\n"
+    "Выбери, о каких новых постах присылать уведомления 👇"
+)
+
+
+@router.callback_query(F.data == "menu_subscriptions")
+async def show_subscriptions(callback: CallbackQuery):
+    await callback.message.edit_text(
+        SUBSCRIPTIONS_TEXT,
+        parse_mode="HTML",
+        reply_markup=await subscriptions_markup(callback.from_user.id)
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data == "sub_notifications")
+async def toggle_all_notifications(callback: CallbackQuery):
+    new_value = await db.toggle_notifications(callback.from_user.id)
+    await callback.message.edit_reply_markup(reply_markup=await subscriptions_markup(callback.from_user.id))
+    await callback.answer("Уведомления включены ✅" if new_value else "Уведомления выключены ❌")
+
+
+@router.callback_query(F.data.startswith("sub_cat_"))
+async def toggle_category_subscription(callback: CallbackQuery):
+    category_id = int(callback.data.split("_")[2])
+    category = await db.get_category(category_id)
+    if not category:
+        await callback.answer("Категория не найдена")
+        return
+
+    subscribed = await db.toggle_category_subscription(callback.from_user.id, category_id)
+    await callback.message.edit_reply_markup(reply_markup=await subscriptions_markup(callback.from_user.id))
+    await callback.answer(f"{category[1]}: {'подписка включена ✅' if subscribed else 'подписка выключена ❌'}")
+
+
 # ========== Каталог товаров ==========
 @router.callback_query(F.data == "menu_catalog")
 async def show_catalog(callback: CallbackQuery):
@@ -600,28 +831,200 @@ async def broadcast_post(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Ошибка: пост не найден")
         return
 
+    await state.clear()
+    await callback.message.edit_text("📢 Рассылка запущена...")
+    await callback.answer()
+
+    # Задание сохраняется в базе и продолжится после перезапуска бота
+    job_id = await db.create_broadcast_job(post_id, callback.message.chat.id, callback.message.message_id)
+    start_broadcast_job(job_id)
+
+
+# Ссылки на фоновые рассылки, чтобы задачи не удалил сборщик мусора
+broadcast_tasks = set()
+
+
+def start_broadcast_job(job_id: int):
+    task = asyncio.create_task(run_broadcast_job(job_id))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+    return task
+
+
+async def resume_broadcast_jobs():
+    """Продолжение рассылок, прерванных перезапуском"""
+    # Рассылки в тихие часы продолжит планировщик, когда наступит окно
+    await db.recover_scheduled_posts()
+    for job_id in await db.get_unfinished_broadcast_jobs():
+        logger.info(f"Resuming broadcast job {job_id}")
+        start_broadcast_job(job_id)
+
+
+async def run_broadcast_job(job_id: int):
+    # Задача рассылки выполняется в своём контексте: её вызовы Bot API пропускают ответы пользователям вперёд
+    gateway.lane.set(gateway.BROADCAST)
+    _, post_id, _, chat_id, message_id, _, _ = await db.get_broadcast_job(job_id)
     post = await db.get_post(post_id)
-    users = await db.get_all_users()
+
+    if not post:
+        await db.finish_broadcast_job(job_id, "failed")
+        return
 
     # Получаем название категории для зазывающих сообщений
     category_name = None
-    if post and post[5]:  # category_id
+    if post[5]:  # category_id
         category = await db.get_category(post[5])
         if category:
             category_name = category[1]
 
-    sent_count = 0
-    for user_id, notifications_enabled in users:
-        if notifications_enabled:
-            if await send_post_to_user(user_id, post, category_name):
-                sent_count += 1
+    async def report_progress(stats: broadcast.BroadcastStats):
+        await bot.edit_message_text(
+            f"📢 Рассылка: {stats.done} из {stats.total}\n"
+            f"✅ Доставлено: {stats.sent}\n"
+            f"❌ Ошибок: {stats.failed}\n"
+            f"⚡ {stats.rate:.1f} сообщ./сек",
+            chat_id=chat_id,
+            message_id=message_id
+        )
+
+    try:
+        stats = await broadcast.run_job(
+            job_id,
+            lambda user_id: send_post_to_user(user_id, post, category_name),
+            on_progress=report_progress,
+            rate=BROADCAST_RATE,
+            concurrency=BROADCAST_CONCURRENCY,
+        )
+    except Exception:
+        logger.exception(f"Broadcast job {job_id} failed")
+        await db.finish_broadcast_job(job_id, "failed")
+        await bot.send_message(chat_id, "❌ Рассылка прервана из-за ошибки.")
+        return
+
+    await bot.edit_message_text(f"📢 Пост разослан {stats.sent} пользователям!", chat_id=chat_id, message_id=message_id)
+    await bot.send_message(chat_id, "📝 Управление постами", reply_markup=kb.posts_management_keyboard())
+
+
+# ========== Отложенные публикации ==========
+def format_local_time(timestamp: float):
+    return datetime.fromtimestamp(timestamp, ZoneInfo(TIMEZONE)).strftime("%d.%m.%Y %H:%M")
+
+
+@router.callback_query(F.data == "broadcast_schedule")
+async def schedule_broadcast_start(callback: CallbackQuery, state: FSMContext):
+    if not (await state.get_data()).get("new_post_id"):
+        await callback.answer("Ошибка: пост не найден")
+        return
+
+    await state.set_state(AddPostStates.waiting_for_publish_time)
+    await callback.message.edit_text(
+        "⏰ Когда разослать пост?\n\n"
+        "Введите время в формате ДД.ММ ЧЧ:ММ или ЧЧ:ММ (часовой пояс бота), "
+        "или выберите тихие часы — большая рассылка будет идти только в них.",
+        reply_markup=kb.schedule_keyboard(OFFPEAK_HOURS)
+    )
+    await callback.answer()
 
+
+@router.message(AddPostStates.waiting_for_publish_time)
+async def schedule_broadcast_time(message: Message, state: FSMContext):
+    now = time.time()
+    publish_at = scheduler.parse_local_time(message.text or "", now, TIMEZONE)
+    if publish_at is None or publish_at <= now:
+        await message.answer("❌ Не удалось разобрать время или оно уже прошло. Пример: 25.12 10:30")
+        return
+
+    post_id = (await state.get_data())["new_post_id"]
     await state.clear()
-    await callback.message.edit_text(f"📢 Пост разослан {sent_count} пользователям!")
+    await db.schedule_post(post_id, publish_at, status_chat_id=message.chat.id)
+    publish_scheduler.add(publish_at)
+
+    await message.answer(f"✅ Рассылка запланирована на {format_local_time(publish_at)}")
+    await message.answer("📝 Управление постами", reply_markup=kb.posts_management_keyboard())
+
+
+@router.callback_query(F.data == "schedule_offpeak")
+async def schedule_broadcast_offpeak(callback: CallbackQuery, state: FSMContext):
+    post_id = (await state.get_data()).get("new_post_id")
+    if not post_id:
+        await callback.answer("Ошибка: пост не найден")
+        return
+
+    await state.clear()
+    now = time.time()
+    publish_at = max(now, offpeak_window(now)[0])
+    await db.schedule_post(post_id, publish_at, offpeak=True, status_chat_id=callback.message.chat.id)
+    publish_scheduler.add(publish_at)
+
+    await callback.message.edit_text(f"✅ Рассылка начнётся в тихие часы: {format_local_time(publish_at)}")
     await callback.message.answer("📝 Управление постами", reply_markup=kb.posts_management_keyboard())
     await callback.answer()
 
 
+def offpeak_window(now: float):
+    return scheduler.offpeak_window(now, OFFPEAK_HOURS, TIMEZONE)
+
+
+# Ссылки на задачи запланированных публикаций
+scheduled_tasks = set()
+
+
+async def fire_scheduled_posts(now: float):
+    for row in await db.claim_due_scheduled_posts(now):
+        task = asyncio.create_task(run_scheduled_post(*row))
+        scheduled_tasks.add(task)
+        task.add_done_callback(scheduled_tasks.discard)
+
+
+publish_scheduler = scheduler.PublishScheduler(fire_scheduled_posts)
+
+
+async def resume_scheduled_posts():
+    """Восстановление очереди отложенных публикаций после перезапуска"""
+    for publish_at in await db.get_pending_schedule_times():
+        publish_scheduler.add(publish_at)
+    publish_scheduler.start()
+
+
+async def run_scheduled_post(schedule_id: int, post_id: int, job_id: int, offpeak: bool, chat_id: int):
+    """Запуск отложенной рассылки; в режиме тихих часов — только внутри окна, с продолжением в следующем"""
+    now = publish_scheduler.clock()
+    if offpeak:
+        window_start, window_end = offpeak_window(now)
+        if now < window_start:
+            await db.reschedule_post(schedule_id, window_start)
+            publish_scheduler.add(window_start)
+            return
+
+    if job_id is None:
+        try:
+            status_message = await bot.send_message(chat_id, "📢 Запланированная рассылка запущена...")
+            job_id = await db.create_broadcast_job(post_id, chat_id, status_message.message_id, schedule_id)
+        except Exception:
+            # Задание не создано: публикация снова ждёт запуска и повторится позже
+            logger.exception(f"Scheduled post {schedule_id} could not start")
+            retry_at = publish_scheduler.clock() + scheduler.RETRY_DELAY
+            await db.reschedule_post(schedule_id, retry_at)
+            publish_scheduler.add(retry_at)
+            return
+    else:
+        await db.set_broadcast_job_status(job_id, "running")
+
+    task = start_broadcast_job(job_id)
+    timeout = window_end - publish_scheduler.clock() if offpeak else None
+    done, _ = await asyncio.wait({task}, timeout=timeout)
+
+    if not done:
+        # Окно закончилось: отметки о доставке сохраняются, рассылка продолжится в следующем окне
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        next_start = offpeak_window(window_end)[0]
+        await db.reschedule_post(schedule_id, next_start)
+        publish_scheduler.add(next_start)
+        await bot.send_message(chat_id, f"⏸ Рассылка приостановлена до {format_local_time(next_start)}")
+    # Итоговый статус публикации (done или failed) записывает finish_broadcast_job
+
+
 @router.callback_query(F.data == "broadcast_no")
 async def skip_broadcast(callback: CallbackQuery, state: FSMContext):
     await state.clear()
@@ -644,13 +1047,13 @@ async def list_posts(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
 
-    posts = await db.get_posts()
+    posts, markup = await posts_page("a")
 
     if posts:
         await callback.message.edit_text(
             "📋 <b>Список постов</b>\n\nВыберите пост для редактирования:",
             parse_mode="HTML",
-            reply_markup=kb.admin_posts_keyboard(posts)
+            reply_markup=markup
         )
     else:
         builder = kb.InlineKeyboardBuilder()
@@ -685,7 +1088,9 @@ async def admin_view_post(callback: CallbackQuery, state: FSMContext):
     text += f"📁 Категория: {cat_name}\n"
     text += f"📂 Подкатегория: {subcat_name}\n"
     text += f"📷 Медиа: {media_type or 'Нет'}\n"
-    text += f"👁 Просмотров: {views}"
+    text += f"👁 Просмотров: {views}\n"
+    week, month, total = await db.get_reach("post", post_id)
+    text += f"👤 Уникальных: {week} за 7 дней, {month} за 30 дней, {total} всего"
 
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.post_actions_keyboard(post_id, "back_to_posts_list"))
     await callback.answer()
@@ -696,11 +1101,11 @@ async def delete_post_confirm(callback: CallbackQuery):
     post_id = int(callback.data.split("_")[2])
     await db.delete_post(post_id)
 
-    posts = await db.get_posts()
+    _, markup = await posts_page("a")
     await callback.message.edit_text(
         "✅ Пост удалён!\n\n📋 <b>Список постов</b>:",
         parse_mode="HTML",
-        reply_markup=kb.admin_posts_keyboard(posts)
+        reply_markup=markup
     )
     await callback.answer("Пост удалён")
 
@@ -755,11 +1160,11 @@ async def edit_post_description(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "back_to_posts_list")
 async def back_to_posts_list(callback: CallbackQuery):
-    posts = await db.get_posts()
+    _, markup = await posts_page("a")
     await callback.message.edit_text(
         "📋 <b>Список постов</b>:",
         parse_mode="HTML",
-        reply_markup=kb.admin_posts_keyboard(posts)
+        reply_markup=markup
     )
     await callback.answer()
 
@@ -992,7 +1397,9 @@ async def admin_view_marathon(callback: CallbackQuery, state: FSMContext):
 
     text = f"{emoji} <b>{name}</b>\n\n"
     text += f"🔗 URL: {url}\n"
-    text += f"👆 Кликов: {clicks}"
+    text += f"👆 Кликов: {clicks}\n"
+    week, month, total = await db.get_reach("marathon", m_id)
+    text += f"👤 Уникальных: {week} за 7 дней, {month} за 30 дней, {total} всего"
 
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.marathon_actions_keyboard(marathon_id))
     await callback.answer()
@@ -1095,16 +1502,32 @@ async def show_statistics(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
 
-    users_count = await db.get_users_count()
-    posts_count = await db.get_posts_count()
-    total_views = await db.get_total_views()
-    total_clicks = await db.get_total_clicks()
+    stats = await db.get_dashboard(days=7, top=5)
 
     text = "📊 <b>Статистика бота</b>\n\n"
-    text += f"👥 Пользователей: {users_count}\n"
-    text += f"📝 Постов: {posts_count}\n"
-    text += f"👁 Всего просмотров: {total_views}\n"
-    text += f"👆 Всего кликов по ссылкам: {total_clicks}"
+    text += f"👥 Пользователей: {stats['users']}\n"
+    text += f"🚫 Заблокировали бота: {stats['blocked']}\n"
+    text += f"❓ Чат не найден: {stats['not_found']}\n"
+    text += f"📝 Постов: {stats['posts']}\n"
+    text += f"👁 Всего просмотров: {stats['views']}\n"
+    text += f"👆 Всего кликов по ссылкам: {stats['clicks']}\n"
+
+    if stats["trend"]:
+        text += "\n📈 <b>По дням</b> (👁 просмотры · 👆 клики · 🙋 активные):\n"
+        for day, views, clicks, active_users in stats["trend"]:
+            text += f"{day[8:10]}.{day[5:7]}: 👁 {views} · 👆 {clicks} · 🙋 {active_users}\n"
+
+    if stats["top_posts"]:
+        text += "\n🔥 <b>Топ постов за 7 дней:</b>\n"
+        for number, (title, views) in enumerate(stats["top_posts"], start=1):
+            text += f"{number}. {html.escape(title[:40])} — {views}\n"
+
+    if stats["top_links"]:
+        text += "\n🔗 <b>Топ ссылок за 7 дней:</b>\n"
+        for number, (name, clicks) in enumerate(stats["top_links"], start=1):
+            text += f"{number}. {html.escape(name)} — {clicks}\n"
+
+    text += f"\n<i>Обновляется раз в {int(ROLLUP_INTERVAL)} сек.</i>"
 
     builder = kb.InlineKeyboardBuilder()
     builder.row(kb.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_admin"))
@@ -1120,9 +1543,8 @@ async def show_settings(callback: CallbackQuery):
         return
 
     # Получаем текущий статус уведомлений
-    users = await db.get_all_users()
-    user = next((u for u in users if u[0] == callback.from_user.id), None)
-    notifications_on = user[1] == 1 if user else True
+    settings = await db.get_user_settings(callback.from_user.id)
+    notifications_on = settings[0] == 1 if settings else True
 
     await callback.message.edit_text(
         "⚙️ <b>Настройки</b>",
@@ -1146,16 +1568,71 @@ async def toggle_notifications(callback: CallbackQuery):
 
 
 # ========== HTTP сервер для health checks ==========
+# Задержка event loop: насколько позже запланированного просыпается фоновая задача
+loop_lag = 0.0
+shutdown_requested = asyncio.Event()
+
+metrics.Gauge("bot_event_loop_lag_seconds", "Event loop scheduling delay", function=lambda: loop_lag)
+
+
+async def monitor_loop_lag():
+    global loop_lag
+    while True:
+        started_at = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag = max(0.0, time.monotonic() - started_at - LOOP_LAG_INTERVAL)
+
+
 async def health_check(request):
     """Endpoint для health check Koyeb"""
     return web.Response(text="OK", status=200)
 
 
-async def run_web_server():
-    """Запуск веб-сервера на порту 8000 для health checks"""
+async def ready_check(request):
+    """Готовность принимать апдейты: база отвечает, loop не перегружен, очередь апдейтов в норме"""
+    checks = {}
+
+    started_at = time.monotonic()
+    try:
+        await asyncio.wait_for(db.ping(), READY_DB_TIMEOUT)
+        checks["database"] = round(time.monotonic() - started_at, 4)
+        db_ok = True
+    except Exception as e:
+        checks["database"] = f"error: {type(e).__name__}"
+        db_ok = False
+
+    checks["loop_lag"] = round(loop_lag, 4)
+    checks["backlog"] = update_scheduler.backlog
+    checks["shutting_down"] = shutdown_requested.is_set()
+
+    ready = (
+        db_ok
+        and loop_lag <= READY_LOOP_LAG
+        and update_scheduler.backlog <= READY_MAX_BACKLOG
+        and not shutdown_requested.is_set()
+    )
+    return web.json_response({"ready": ready, **checks}, status=200 if ready else 503)
+
+
+async def metrics_handler(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def run_web_server(webhook: bool = False):
+    """Запуск веб-сервера на порту 8000 для health checks (и приёма webhook)"""
     app = web.Application()
     app.router.add_get("/", health_check)
     app.router.add_get("/health", health_check)
+    app.router.add_get("/ready", ready_check)
+    app.router.add_get("/metrics", metrics_handler)
+
+    if webhook:
+        # Telegram получает ответ сразу, апдейт обрабатывается в фоне
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -1165,23 +1642,108 @@ async def run_web_server():
     await site.start()
 
     logger.info(f"Web server started on port {port}")
+    return runner
 
 
 # ========== Запуск бота ==========
-async def main():
-    # Инициализация базы данных
-    await db.init_db()
+def request_shutdown():
+    if not shutdown_requested.is_set():
+        logger.info("Shutdown requested")
+        shutdown_requested.set()
 
-    # Восстановление марафонов если удалены
-    await db.restore_marathons()
 
-    logger.info("Bot started!")
+async def drain():
+    """Остановка рассылок и ожидание уже принятых апдейтов"""
+    # Отметки о доставке сохраняются при отмене: после перезапуска рассылки продолжатся
+    await publish_scheduler.stop()
+    tasks = list(scheduled_tasks) + list(broadcast_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
-    # Запуск веб-сервера для health checks
-    asyncio.create_task(run_web_server())
+    while update_scheduler.backlog:
+        await asyncio.sleep(0.1)
 
-    # Запуск polling
-    await dp.start_polling(bot)
+
+async def main():
+    global WEBHOOK_SECRET
+    # Открытие пула соединений с базой
+    await db.open_pool(DB_READ_POOL_SIZE, SQLITE_PRAGMAS, SQLITE_VACUUM_ON_START)
+
+    try:
+        # Инициализация базы данных
+        await db.init_db()
+
+        # Восстановление марафонов если удалены
+        await db.restore_marathons()
+
+        # Фоновая запись просмотров и кликов
+        db.start_event_buffer(EVENT_FLUSH_INTERVAL, EVENT_FLUSH_SIZE)
+
+        # Фоновое обновление сводок статистики
+        db.start_compactor(ROLLUP_INTERVAL, EVENT_RETENTION_DAYS, EVENT_ARCHIVE_DIR)
+
+        # Очистка просроченных состояний FSM
+        if isinstance(storage, fsm_storage.SQLiteStorage):
+            storage.start_cleanup()
+
+        # Продолжение незавершённых рассылок и очереди отложенных публикаций
+        await resume_broadcast_jobs()
+        await resume_scheduled_posts()
+
+        webhook = BOT_MODE == "webhook"
+        if webhook and not WEBHOOK_URL:
+            logger.warning("BOT_MODE=webhook requires WEBHOOK_URL, falling back to polling")
+            webhook = False
+        if webhook and not WEBHOOK_SECRET:
+            # Без секрета вебхук принимал бы апдейты от кого угодно
+            logger.warning("WEBHOOK_SECRET is not set, generated a random one (set it explicitly when running several instances)")
+            WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+        # Запуск веб-сервера для health checks
+        runner = await run_web_server(webhook)
+        lag_monitor = asyncio.create_task(monitor_loop_lag())
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, request_shutdown)
+        logger.info("Bot started!")
+
+        try:
+            if webhook:
+                await bot.set_webhook(
+                    WEBHOOK_URL + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=dp.resolve_used_update_types(),
+                )
+                logger.info(f"Receiving updates via webhook {WEBHOOK_URL + WEBHOOK_PATH}")
+                await shutdown_requested.wait()
+                # Новые апдейты больше не принимаются: Telegram повторит их позже
+                for site in list(runner.sites):
+                    await site.stop()
+            else:
+                # Запуск polling (вебхук, если был установлен, мешает getUpdates)
+                await bot.delete_webhook()
+                polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+                stop = asyncio.create_task(shutdown_requested.wait())
+                await asyncio.wait({polling, stop}, return_when=asyncio.FIRST_COMPLETED)
+                if not polling.done():
+                    await dp.stop_polling()
+                stop.cancel()
+                await polling
+
+            try:
+                await asyncio.wait_for(drain(), SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Shutdown deadline of {SHUTDOWN_TIMEOUT}s exceeded, {update_scheduler.backlog} updates dropped")
+        finally:
+            lag_monitor.cancel()
+            await runner.cleanup()
+    finally:
+        # close_pool сбрасывает буфер просмотров и кликов и дописывает очередь записи
+        await dp.storage.close()
+        await db.close_pool()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+import time
+from functools import wraps
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Все метрики процесса в порядке создания
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        REGISTRY.append(self)
+        if not self.labelnames:
+            self._default()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _default(self):
+        # Метрика без меток ведёт себя как свой единственный ребёнок
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик"""
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+
+
+class Gauge(_Metric):
+    """Текущее значение; function, если задана, вызывается при каждом сборе метрик"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Histogram(_Metric):
+    """Распределение значений (длительностей) по корзинам"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip(child.buckets, child.counts):
+            cumulative += count
+            le = _labels(self.labelnames, values, f'le="{_number(bound)}"')
+            yield f"{self.name}_bucket{le} {cumulative}"
+        labels = _labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_number(child.sum)}"
+        yield f"{self.name}_count{labels} {child.count}"
+
+
+def timed(histogram: Histogram, *labels):
+    """Декоратор: длительность вызова корутины записывается в histogram"""
+    def decorator(func):
+        child = histogram.labels(*labels)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started_at)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
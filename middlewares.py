@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+
+import metrics
+
+# Сколько апдейтов обрабатывается одновременно
+UPDATE_CONCURRENCY = 32
+
+UPDATE_WAIT = metrics.Histogram(
+    "bot_update_wait_seconds", "Time updates wait for their chat queue and a handler slot"
+)
+UPDATES_PROCESSED = metrics.Counter("bot_updates_processed_total", "Updates passed to handlers")
+HANDLER_DURATION = metrics.Histogram(
+    "bot_handler_duration_seconds", "Duration of update handlers", ["handler"]
+)
+HANDLER_ERRORS = metrics.Counter("bot_handler_errors_total", "Handler exceptions", ["handler"])
+
+
+class UpdateScheduler(BaseMiddleware):
+    """Ограничение параллельной обработки апдейтов.
+
+    Разные пользователи обслуживаются параллельно (не больше concurrency
+    апдейтов сразу), а апдейты одного пользователя в одном чате — строго
+    по очереди, в порядке поступления: на этом держатся сценарии FSM.
+    Подключается через setup_update_scheduler — раньше middleware FSM.
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY):
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        # Очереди по чатам: ключ -> [lock, число апдейтов в очереди]
+        self._chats = {}
+
+        # Метрики нагрузки
+        self.active = 0          # обрабатываются сейчас
+        self.waiting = 0         # ждут очереди чата или свободного слота
+
+    @property
+    def backlog(self):
+        return self.active + self.waiting
+
+    @property
+    def chats_queued(self):
+        return len(self._chats)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = (chat.id if chat else None, user.id if user else None)
+
+        # asyncio.Lock пропускает ожидающих в порядке очереди
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.waiting += 1
+        queued_at = time.monotonic()
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    UPDATE_WAIT.observe(time.monotonic() - queued_at)
+                    self.waiting -= 1
+                    self.active += 1
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.active -= 1
+                        UPDATES_PROCESSED.inc()
+                        queued_at = None
+        finally:
+            if queued_at is not None:
+                # Отмена до начала обработки
+                self.waiting -= 1
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+
+def setup_update_scheduler(dispatcher: Dispatcher, scheduler: UpdateScheduler):
+    """Подключить scheduler к апдейтам диспетчера перед middleware FSM.
+
+    Dispatcher регистрирует FSM в конструкторе, а FSM читает состояние
+    до вызова следующих middleware: очередь чата должна стоять раньше,
+    иначе два быстрых сообщения попадут в обработчик одного состояния.
+    """
+    dispatcher.update.outer_middleware.unregister(dispatcher.fsm)
+    dispatcher.update.outer_middleware(scheduler)
+    dispatcher.update.outer_middleware(dispatcher.fsm)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Время работы и ошибки каждого обработчика (внутренний middleware роутера)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_DURATION.labels(name).observe(time.perf_counter() - started_at)
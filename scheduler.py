@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Тихие часы для рассылок (местное время): начало и конец, конец может быть после полуночи
+OFFPEAK_HOURS = (10, 12)
+TIMEZONE = "Europe/Moscow"
+# Не спать дольше: страховка от перевода системных часов
+MAX_SLEEP = 60.0
+# Через сколько секунд повторить срабатывание или запуск публикации после ошибки
+RETRY_DELAY = 30.0
+
+
+def offpeak_window(now: float, hours: tuple = OFFPEAK_HOURS, tz: str = TIMEZONE):
+    """(начало, конец) текущего или ближайшего окна тихих часов, в секундах epoch"""
+    start_hour, end_hour = hours
+    zone = ZoneInfo(tz)
+    local = datetime.fromtimestamp(now, zone)
+    # Окно, начавшееся вчера, может ещё идти (например, 22–2)
+    for day in (local.date() - timedelta(days=1), local.date(), local.date() + timedelta(days=1)):
+        start = datetime(day.year, day.month, day.day, start_hour, tzinfo=zone)
+        end = datetime(day.year, day.month, day.day, end_hour, tzinfo=zone)
+        if end <= start:
+            end += timedelta(days=1)
+        if now < end.timestamp():
+            return start.timestamp(), end.timestamp()
+    return start.timestamp(), end.timestamp()
+
+
+def parse_local_time(text: str, now: float, tz: str = TIMEZONE):
+    """Время из «ДД.ММ.ГГГГ ЧЧ:ММ», «ДД.ММ ЧЧ:ММ» или «ЧЧ:ММ» (ближайшее такое) в секундах epoch; None, если не разобрано"""
+    zone = ZoneInfo(tz)
+    local_now = datetime.fromtimestamp(now, zone)
+    text = " ".join(text.split())
+    for fmt in ("%d.%m.%Y %H:%M", "%d.%m %H:%M", "%H:%M"):
+        # Без явного года разбираем в високосном году, иначе 29.02 не разбирается
+        if "%Y" not in fmt:
+            text_with_year, year_fmt = f"2000 {text}", f"%Y {fmt}"
+        else:
+            text_with_year, year_fmt = text, fmt
+        try:
+            parsed = datetime.strptime(text_with_year, year_fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            moment = local_now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if moment.timestamp() <= now:
+                moment += timedelta(days=1)
+        elif fmt == "%d.%m %H:%M":
+            # Ближайшая ещё не наступившая такая дата; 29.02 бывает не каждый год
+            for year in range(local_now.year, local_now.year + 9):
+                try:
+                    moment = parsed.replace(year=year, tzinfo=zone)
+                except ValueError:
+                    continue
+                if moment.timestamp() > now:
+                    break
+        else:
+            moment = parsed.replace(tzinfo=zone)
+        return moment.timestamp()
+    return None
+
+
+class PublishScheduler:
+    """Таймер запланированных публикаций.
+
+    В куче — моменты срабатывания; при пробуждении fire(now) забирает из базы
+    все наступившие записи. clock можно подменить, чтобы управлять временем.
+    """
+
+    def __init__(self, fire, clock=time.time, max_sleep: float = MAX_SLEEP, retry_delay: float = RETRY_DELAY):
+        self.fire = fire
+        self.clock = clock
+        self.max_sleep = max_sleep
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, run_at: float):
+        heapq.heappush(self._heap, run_at)
+        self._wakeup.set()
+
+    def next_run_at(self):
+        return self._heap[0] if self._heap else None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def tick(self):
+        """Срабатывание, если подошло время ближайшей записи; возвращает задержку до следующей"""
+        now = self.clock()
+        if self._heap and self._heap[0] <= now:
+            while self._heap and self._heap[0] <= now:
+                heapq.heappop(self._heap)
+            try:
+                await self.fire(now)
+            except Exception:
+                # Наступившие записи остаются в базе pending — пробуем снова позже
+                logger.exception("Scheduled publication failed")
+                heapq.heappush(self._heap, now + self.retry_delay)
+        if not self._heap:
+            return self.max_sleep
+        return min(max(0.0, self._heap[0] - self.clock()), self.max_sleep)
+
+    async def _run(self):
+        while True:
+            delay = await self.tick()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,13 @@
+def percentile(samples, q: float) -> float:
+    """q-й процентиль (0..100) по ближайшему рангу"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:.2f}ms"
+
+
+def us(seconds: float) -> str:
+    return f"{seconds * 1e6:.1f}us"
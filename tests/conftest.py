@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db  # noqa: E402
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", help="запустить замеры производительности (slow)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: замер производительности, запускается с --runslow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip = pytest.mark.skip(reason="замер производительности: запустите с --runslow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def report(capsys):
+    """Вывести результат замера в консоль, минуя перехват вывода pytest"""
+    def show(title, **values):
+        with capsys.disabled():
+            print(f"\n{title}: " + ", ".join(f"{name}={value}" for name, value in values.items()))
+    return show
+
+
+@pytest.fixture
+def run_db(tmp_path, monkeypatch):
+    """Выполнить корутину scenario() на новой базе с открытым пулом соединений"""
+    monkeypatch.setattr(db, "DATABASE_PATH", str(tmp_path / "bot.db"))
+
+    def run(scenario):
+        async def main():
+            await db.open_pool()
+            try:
+                await db.init_db()
+                db.invalidate_catalog()
+                return await scenario()
+            finally:
+                await db.close_pool()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+TOKEN = "42:TEST"
+
+
+class FakeBotAPI:
+    """Локальный сервер с ответами Bot API для тестов и замеров.
+
+    Каждый вызов записывается в calls как (время, метод, chat_id).
+    blocked и missing — чаты, для которых отправка завершается ошибкой 403
+    и 400 «chat not found»; retry_after[chat_id] — сколько раз ответить 429;
+    latency — задержка каждого ответа, секунды. Апдейты, добавленные через
+    push_update, отдаются long polling'ом getUpdates.
+    """
+
+    def __init__(self, blocked=(), missing=(), retry_after=None, latency: float = 0.0):
+        self.blocked = set(blocked)
+        self.missing = set(missing)
+        self.retry_after = dict(retry_after or {})
+        self.latency = latency
+        self.calls = []
+        self._message_id = 0
+        self._updates = []
+        self._update_added = asyncio.Event()
+        self._runner = None
+        self.url = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
+
+    def bot(self, *middlewares, limit: int = 100):
+        session = AiohttpSession(api=TelegramAPIServer.from_base(self.url), limit=limit)
+        for middleware in middlewares:
+            session.middleware(middleware)
+        return Bot(TOKEN, session=session)
+
+    def sent_to(self, chat_id):
+        return [call for call in self.calls if call[2] == chat_id]
+
+    def push_update(self, update: dict):
+        self._updates.append(update)
+        self._update_added.set()
+
+    async def _get_updates(self, data):
+        offset = int(data.get("offset", 0))
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._update_added.clear()
+            try:
+                await asyncio.wait_for(self._update_added.wait(), float(data.get("timeout", 0)))
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": self._updates[:int(data.get("limit", 100))]})
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        data = await request.post()
+        chat_id = int(data["chat_id"]) if "chat_id" in data else None
+        self.calls.append((time.monotonic(), method, chat_id))
+        if method.lower() == "getupdates":
+            return await self._get_updates(data)
+        if method.lower() == "getme":
+            return web.json_response({"ok": True, "result": {"id": 42, "is_bot": True, "first_name": "Test"}})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.retry_after.get(chat_id):
+            self.retry_after[chat_id] -= 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        if chat_id in self.blocked:
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403
+            )
+        if chat_id in self.missing:
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: chat not found"},
+                                     status=400)
+
+        if method.lower().startswith("send") or method.lower().startswith("edit"):
+            self._message_id += 1
+            return web.json_response({"ok": True, "result": {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }})
+        return web.json_response({"ok": True, "result": True})
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+import database as db
+from bench import percentile, us
+
+pytestmark = pytest.mark.slow
+
+NAVIGATIONS = 5000
+
+
+async def navigate_uncached(category_id: int):
+    """Прежняя навигация: show_category и show_marathons читают справочники из базы"""
+    async with db.reading() as conn:
+        cursor = await conn.execute("SELECT id, name, emoji FROM categories WHERE id = ?", (category_id,))
+        await cursor.fetchone()
+        cursor = await conn.execute("SELECT id, name FROM subcategories WHERE category_id = ?", (category_id,))
+        await cursor.fetchall()
+        cursor = await conn.execute("SELECT id, name, url, emoji, clicks FROM marathons")
+        await cursor.fetchall()
+
+
+async def navigate_cached(category_id: int):
+    await db.get_category(category_id)
+    await db.get_subcategories(category_id)
+    await db.get_marathons()
+
+
+async def latencies(navigate):
+    samples = []
+    for i in range(NAVIGATIONS):
+        started = time.perf_counter()
+        await navigate(i % 10 + 1)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def test_cached_catalog_navigation_latency(run_db, report, monkeypatch):
+    reads = []
+    pool_reading = db.reading
+
+    def counting_reading():
+        reads.append(1)
+        return pool_reading()
+
+    async def scenario():
+        for i in range(10):
+            await db.add_category(f"Категория {i}")
+            for j in range(5):
+                await db.add_subcategory(f"Подкатегория {i}.{j}", i + 1)
+        uncached = await latencies(navigate_uncached)
+
+        await db.get_categories()
+        monkeypatch.setattr(db, "reading", counting_reading)
+        cached = await latencies(navigate_cached)
+        return uncached, cached
+
+    uncached, cached = run_db(scenario)
+
+    report(
+        f"{NAVIGATIONS} navigations",
+        database_p50=us(percentile(uncached, 50)), database_p99=us(percentile(uncached, 99)),
+        cache_p50=us(percentile(cached, 50)), cache_p99=us(percentile(cached, 99)),
+    )
+    # В установившемся режиме навигация не обращается к базе
+    assert reads == []
+    assert percentile(cached, 50) < percentile(uncached, 50)
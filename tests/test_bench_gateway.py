@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+import gateway
+from bench import ms, percentile
+from fake_bot_api import FakeBotAPI
+
+pytestmark = pytest.mark.slow
+
+RATE = 100  # общий лимит шлюза, вызовов в секунду
+BROADCAST_SENDERS = 50
+BROADCAST_MESSAGES = 600
+INTERACTIVE_REPLIES = 40
+INTERACTIVE_INTERVAL = 0.1
+
+
+async def mixed_load(api: FakeBotAPI, interactive_lane: int):
+    """Рассылка забирает весь лимит; тем временем пользователи получают ответы"""
+    outbound = gateway.OutboundGateway(rate=RATE)
+    bot = api.bot(outbound)
+    recipients = iter(range(1, BROADCAST_MESSAGES + 1))
+
+    async def broadcast_sender():
+        gateway.lane.set(gateway.BROADCAST)
+        for chat_id in recipients:
+            await bot.send_message(chat_id, "Новый пост")
+
+    async def reply(chat_id):
+        gateway.lane.set(interactive_lane)
+        started = time.monotonic()
+        await bot.send_message(chat_id, "Ответ")
+        return time.monotonic() - started
+
+    senders = [asyncio.create_task(broadcast_sender()) for _ in range(BROADCAST_SENDERS)]
+    await asyncio.sleep(0.5)
+    replies = []
+    for i in range(INTERACTIVE_REPLIES):
+        replies.append(asyncio.create_task(reply(10_000 + i)))
+        await asyncio.sleep(INTERACTIVE_INTERVAL)
+    latencies = await asyncio.gather(*replies)
+    for sender in senders:
+        sender.cancel()
+    await asyncio.gather(*senders, return_exceptions=True)
+    await bot.session.close()
+    return latencies
+
+
+def test_interactive_latency_under_broadcast_load(report):
+    async def scenario():
+        async with FakeBotAPI(latency=0.02) as api:
+            prioritized = await mixed_load(api, gateway.INTERACTIVE)
+        async with FakeBotAPI(latency=0.02) as api:
+            # Без полос приоритета ответ ждёт в общей очереди за рассылкой
+            fifo = await mixed_load(api, gateway.BROADCAST)
+        return prioritized, fifo
+
+    prioritized, fifo = asyncio.run(scenario())
+
+    report(
+        f"{INTERACTIVE_REPLIES} replies during a broadcast at the {RATE}/s limit",
+        priority_p50=ms(percentile(prioritized, 50)), priority_p99=ms(percentile(prioritized, 99)),
+        single_lane_p50=ms(percentile(fifo, 50)), single_lane_p99=ms(percentile(fifo, 99)),
+    )
+    assert percentile(prioritized, 99) < percentile(fifo, 50)
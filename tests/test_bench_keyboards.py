@@ -0,0 +1,31 @@
+import timeit
+
+import pytest
+
+import keyboards as kb
+from bench import us
+
+pytestmark = pytest.mark.slow
+
+CALLS = 2000
+
+SUBCATEGORIES = [(i, f"Подкатегория {i}") for i in range(1, 9)]
+MARATHONS = [(i, f"Марафон {i}", f"https://example.com/{i}", "➡️", i * 10) for i in range(1, 7)]
+
+# Клавиатуры, которые строятся на каждый callback навигации
+CALLBACKS = {
+    "main_menu": (kb.main_menu_keyboard, ()),
+    "catalog": (kb.catalog_keyboard, ()),
+    "subcategories": (kb.subcategories_inline_keyboard, (SUBCATEGORIES, 1)),
+    "marathons": (kb.marathons_inline_keyboard, (MARATHONS,)),
+}
+
+
+def test_memoized_markup_construction(report):
+    for name, (keyboard, args) in CALLBACKS.items():
+        built = timeit.timeit(lambda: keyboard.__wrapped__(*args), number=CALLS) / CALLS
+        cached = timeit.timeit(lambda: keyboard(*args), number=CALLS) / CALLS
+
+        report(f"{name} keyboard per callback", built=us(built), cached=us(cached))
+        assert keyboard(*args) == keyboard.__wrapped__(*args)
+        assert cached < built
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import aiosqlite
+import pytest
+
+import database as db
+
+pytestmark = pytest.mark.slow
+
+OPERATIONS = 4000
+CONCURRENCY = 20
+WRITE_EVERY = 10  # одна регистрация пользователя на девять открытий поста
+
+GET_POST = "SELECT id, title, description, media_type, media_file_id, category_id, subcategory_id, views FROM posts WHERE id = ?"
+ADD_USER = "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)"
+
+
+async def connect_per_call_get_post(post_id: int):
+    """Прежний доступ к базе: новое соединение (и поток aiosqlite) на каждый запрос"""
+    async with aiosqlite.connect(db.DATABASE_PATH) as conn:
+        cursor = await conn.execute(GET_POST, (post_id,))
+        return await cursor.fetchone()
+
+
+async def connect_per_call_add_user(user_id: int):
+    async with aiosqlite.connect(db.DATABASE_PATH) as conn:
+        await conn.execute(ADD_USER, (user_id, "user", "User"))
+        await conn.commit()
+
+
+async def measure(get_post, add_user, first_user_id: int):
+    """Запросов в секунду при CONCURRENCY одновременных обработчиках"""
+    operations = iter(range(OPERATIONS))
+
+    async def worker():
+        for i in operations:
+            if i % WRITE_EVERY == 0:
+                await add_user(first_user_id + i)
+            else:
+                assert await get_post(i % 100 + 1)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    return OPERATIONS / (time.perf_counter() - started)
+
+
+def test_pool_vs_connect_per_call_qps(run_db, report):
+    async def scenario():
+        async with db.writing() as conn:
+            await conn.executemany(
+                "INSERT INTO posts (title, description) VALUES (?, ?)",
+                [(f"Пост {i}", "Описание") for i in range(100)]
+            )
+        baseline = await measure(connect_per_call_get_post, connect_per_call_add_user, 1_000_000)
+        pooled = await measure(db.get_post, db.add_user, 2_000_000)
+        return baseline, pooled
+
+    baseline, pooled = run_db(scenario)
+
+    report(
+        f"{OPERATIONS} queries, {CONCURRENCY} concurrent, 1 write per {WRITE_EVERY}",
+        connect_per_call=f"{baseline:.0f} qps", pool=f"{pooled:.0f} qps", speedup=f"{pooled / baseline:.1f}x",
+    )
+    assert pooled > baseline
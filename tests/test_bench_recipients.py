@@ -0,0 +1,75 @@
+import tracemalloc
+
+import pytest
+
+import database as db
+
+pytestmark = pytest.mark.slow
+
+USERS = 500_000
+
+
+async def add_users(first: int, count: int):
+    # Каждый десятый пользователь отключил уведомления
+    async with db.writing() as conn:
+        await conn.executemany(
+            "INSERT INTO users (user_id, username, first_name, notifications_enabled) VALUES (?, ?, ?, ?)",
+            ((user_id, f"user{user_id}", "User", int(user_id % 10 != 0)) for user_id in range(first, first + count))
+        )
+
+
+async def fetch_all_recipients():
+    """Прежний путь рассылки: вся таблица users в памяти, фильтр в Python"""
+    async with db.reading() as conn:
+        cursor = await conn.execute("SELECT user_id, notifications_enabled FROM users")
+        users = await cursor.fetchall()
+    return sum(1 for user_id, enabled in users if enabled)
+
+
+async def stream_recipients(job_id: int):
+    count = 0
+    async for _ in db.iter_broadcast_recipients(job_id):
+        count += 1
+    return count
+
+
+async def peak_memory(coroutine):
+    tracemalloc.start()
+    try:
+        result = await coroutine
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def mb(size: int) -> str:
+    return f"{size / 2 ** 20:.1f}MB"
+
+
+def test_streaming_recipients_memory_stays_flat(run_db, report):
+    async def scenario():
+        async with db.writing() as conn:
+            cursor = await conn.execute("INSERT INTO posts (title, description) VALUES ('Пост', 'Описание')")
+            post_id = cursor.lastrowid
+        job_id = await db.create_broadcast_job(post_id)
+
+        peaks = {}
+        added = 0
+        for size in (50_000, USERS):
+            for first in range(added, size, 50_000):
+                await add_users(first + 1, 50_000)
+            added = size
+            fetched, fetch_peak = await peak_memory(fetch_all_recipients())
+            streamed, stream_peak = await peak_memory(stream_recipients(job_id))
+            assert fetched == streamed == size * 9 // 10
+            peaks[size] = fetch_peak, stream_peak
+        return peaks
+
+    peaks = run_db(scenario)
+
+    for size, (fetch_peak, stream_peak) in peaks.items():
+        report(f"{size} users", fetchall=mb(fetch_peak), streaming=mb(stream_peak))
+    small, large = peaks[50_000][1], peaks[USERS][1]
+    # Память потокового чтения не растёт с числом пользователей, fetchall — растёт линейно
+    assert large < small * 1.5
+    assert peaks[USERS][0] > large * 10
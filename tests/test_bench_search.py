@@ -0,0 +1,64 @@
+import random
+import time
+
+import pytest
+
+import database as db
+from bench import ms, percentile
+
+pytestmark = pytest.mark.slow
+
+POSTS = 100_000
+SEARCHES = 50
+
+# Словарь синтетического корпуса: частые слова встречаются в большинстве постов, редкие — в единицах
+_letters = random.Random(0)
+WORDS = ["".join(_letters.choices("абвгдежзиклмнопрстуфхцчшэюя", k=_letters.randint(5, 9))) for _ in range(5000)]
+COMMON = ["здоровье", "питание", "бизнес", "витамины", "марафон"]
+
+
+def synthetic_post(rng: random.Random):
+    title = " ".join(rng.sample(COMMON, 1) + rng.choices(WORDS, k=4))
+    description = " ".join(rng.choices(COMMON, k=5) + rng.choices(WORDS, k=60))
+    return title, description
+
+
+QUERIES = {
+    "common word": "здоровье",
+    "rare word": WORDS[1234],
+    "common and rare word": f"питание {WORDS[42]}",
+    "prefix": "вита",
+    "page 5": ("марафон", 5),
+}
+
+
+def test_search_latency_at_100k_posts(run_db, report):
+    async def scenario():
+        rng = random.Random(1)
+        for _ in range(POSTS // 10_000):
+            async with db.writing() as conn:
+                await conn.executemany(
+                    "INSERT INTO posts (title, description) VALUES (?, ?)",
+                    [synthetic_post(rng) for _ in range(10_000)]
+                )
+
+        results = {}
+        for name, query in QUERIES.items():
+            text, page = query if isinstance(query, tuple) else (query, 0)
+            samples = []
+            for _ in range(SEARCHES):
+                started = time.perf_counter()
+                rows, _ = await db.search_posts(text, page)
+                samples.append(time.perf_counter() - started)
+            assert rows
+            results[name] = samples
+        return results
+
+    results = run_db(scenario)
+
+    for name, samples in results.items():
+        report(f"{POSTS} posts, {name}", p50=ms(percentile(samples, 50)), p99=ms(percentile(samples, 99)))
+    # Запрос с редким словом ранжирует единицы совпадений; слово из большинства постов
+    # требует оценки BM25 для каждого совпадения и только выводится в отчёт
+    assert percentile(results["rare word"], 99) < 0.02
+    assert percentile(results["common and rare word"], 99) < 0.05
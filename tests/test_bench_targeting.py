@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import broadcast
+import database as db
+from fake_bot_api import FakeBotAPI
+
+pytestmark = pytest.mark.slow
+
+USERS = 5000
+CATEGORIES = 5
+RATE = 1000  # сообщений в секунду, чтобы замер шёл секунды, а не минуты
+
+
+async def everyone():
+    """Прежняя рассылка: все пользователи с включёнными уведомлениями"""
+    async with db.reading() as conn:
+        cursor = await conn.execute("SELECT user_id FROM users WHERE notifications_enabled = 1 ORDER BY user_id")
+        for (user_id,) in await cursor.fetchall():
+            yield user_id
+
+
+async def timed_broadcast(api: FakeBotAPI, recipients):
+    bot = api.bot()
+
+    async def send(chat_id):
+        await bot.send_message(chat_id, "Новый пост")
+        return broadcast.SENT
+
+    sent_before = len(api.calls)
+    started = time.perf_counter()
+    stats = await broadcast.run_broadcast(recipients, send, rate=RATE, concurrency=20)
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+    assert stats.sent == len(api.calls) - sent_before
+    return stats.sent, elapsed
+
+
+def test_targeted_vs_broadcast_to_everyone(run_db, report):
+    async def scenario():
+        for i in range(CATEGORIES):
+            await db.add_category(f"Категория {i}")
+        categories = [row[0] for row in await db.get_categories()]
+        async with db.writing() as conn:
+            await conn.executemany(
+                "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+                [(user_id, f"user{user_id}", "User") for user_id in range(1, USERS + 1)]
+            )
+            # Каждый пользователь оставил подписку на одну категорию из пяти
+            await conn.executemany(
+                "INSERT INTO user_category_subscriptions (user_id, category_id, subscribed) VALUES (?, ?, 0)",
+                [
+                    (user_id, category_id)
+                    for user_id in range(1, USERS + 1)
+                    for category_id in categories
+                    if category_id != categories[user_id % CATEGORIES]
+                ]
+            )
+            cursor = await conn.execute(
+                "INSERT INTO posts (title, description, category_id) VALUES ('Пост', 'Описание', ?)", (categories[0],)
+            )
+            post_id = cursor.lastrowid
+        job_id = await db.create_broadcast_job(post_id)
+        expected = await db.count_broadcast_recipients(job_id)
+
+        async with FakeBotAPI() as api:
+            all_sends, all_time = await timed_broadcast(api, everyone())
+            targeted_sends, targeted_time = await timed_broadcast(api, db.iter_broadcast_recipients(job_id))
+        assert targeted_sends == expected
+        return all_sends, all_time, targeted_sends, targeted_time
+
+    all_sends, all_time, targeted_sends, targeted_time = run_db(scenario)
+
+    report(
+        f"{USERS} users, {CATEGORIES} categories, one subscription each",
+        everyone=f"{all_sends} sends in {all_time:.1f}s",
+        targeted=f"{targeted_sends} sends in {targeted_time:.1f}s",
+        at_default_rate=f"{all_sends / broadcast.GLOBAL_RATE:.0f}s vs {targeted_sends / broadcast.GLOBAL_RATE:.0f}s",
+    )
+    assert all_sends == USERS
+    assert targeted_sends == USERS // CATEGORIES
+    assert targeted_time < all_time
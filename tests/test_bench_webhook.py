@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiogram import Dispatcher, Router
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from bench import ms, percentile
+from fake_bot_api import FakeBotAPI
+from middlewares import UpdateScheduler, setup_update_scheduler
+
+pytestmark = pytest.mark.slow
+
+UPDATES = 2000
+USERS = 200
+RATE = 400  # апдейтов в секунду
+SECRET = "bench-secret"
+
+
+def recorded_updates():
+    """Записанный поток сообщений: USERS пользователей пишут боту по очереди"""
+    return [
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": 1000 + update_id % USERS, "type": "private"},
+                "from": {"id": 1000 + update_id % USERS, "is_bot": False, "first_name": "User"},
+                "text": "/start",
+            },
+        }
+        for update_id in range(1, UPDATES + 1)
+    ]
+
+
+def make_dispatcher(done: dict, finished: asyncio.Event):
+    """Диспетчер как в main: планировщик апдейтов перед FSM, ответ через Bot API"""
+    dp = Dispatcher(storage=MemoryStorage())
+    router = Router()
+    dp.include_router(router)
+    setup_update_scheduler(dp, UpdateScheduler())
+
+    @router.message()
+    async def reply(message: Message):
+        await message.answer("Привет!")
+        done[message.message_id] = time.monotonic()
+        if len(done) == UPDATES:
+            finished.set()
+
+    return dp
+
+
+async def replay(updates, deliver):
+    """Передать апдейты с постоянной скоростью RATE; вернуть время передачи каждого"""
+    sent = {}
+    tasks = []
+    started = time.monotonic()
+    for i, update in enumerate(updates):
+        delay = started + i / RATE - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent[update["update_id"]] = time.monotonic()
+        tasks.append(asyncio.create_task(deliver(update)))
+    await asyncio.gather(*tasks)
+    return sent
+
+
+async def run_webhook(api: FakeBotAPI, updates):
+    done, finished = {}, asyncio.Event()
+    dp = make_dispatcher(done, finished)
+    bot = api.bot()
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=SECRET, handle_in_background=True).register(
+        app, path="/webhook"
+    )
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook"
+
+    # Telegram держит до 40 соединений с вебхуком
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=40)) as client:
+        async def deliver(update):
+            async with client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                assert response.status == 200
+
+        sent = await replay(updates, deliver)
+        await asyncio.wait_for(finished.wait(), 60)
+
+    await runner.cleanup()
+    return [done[update_id] - sent[update_id] for update_id in sent]
+
+
+async def run_polling(api: FakeBotAPI, updates):
+    done, finished = {}, asyncio.Event()
+    dp = make_dispatcher(done, finished)
+    bot = api.bot()
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+    async def deliver(update):
+        api.push_update(update)
+
+    sent = await replay(updates, deliver)
+    await asyncio.wait_for(finished.wait(), 60)
+    await dp.stop_polling()
+    await polling
+    await bot.session.close()
+    return [done[update_id] - sent[update_id] for update_id in sent]
+
+
+@pytest.mark.parametrize("mode", ["webhook", "polling"])
+def test_replayed_updates_latency(mode, report):
+    async def scenario():
+        async with FakeBotAPI(latency=0.005) as api:
+            run = run_webhook if mode == "webhook" else run_polling
+            return await run(api, recorded_updates())
+
+    latencies = asyncio.run(scenario())
+
+    assert len(latencies) == UPDATES
+    report(
+        f"{mode}: {UPDATES} updates at {RATE}/s",
+        p50=ms(percentile(latencies, 50)), p99=ms(percentile(latencies, 99)),
+    )
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+import broadcast
+from fake_bot_api import FakeBotAPI
+
+
+def sender(bot):
+    """Отправка как в main.send_post_to_user: RetryAfter уходит движку, остальное — в результат"""
+    async def send(chat_id):
+        try:
+            await bot.send_message(chat_id, "Новый пост")
+            return broadcast.SENT
+        except TelegramRetryAfter:
+            raise
+        except Exception as e:
+            return broadcast.classify_error(e)
+    return send
+
+
+def test_broadcast_against_fake_bot_api():
+    recipients = list(range(1, 61))
+
+    async def scenario():
+        async with FakeBotAPI(blocked={5, 6, 7}, missing={8, 9}, retry_after={1: 1}) as api:
+            bot = api.bot()
+            results = {}
+
+            async def on_result(chat_id, result):
+                results[chat_id] = result
+
+            stats = await broadcast.run_broadcast(
+                recipients, sender(bot), on_result=on_result, rate=50, concurrency=30
+            )
+            await bot.session.close()
+            return api, stats, results
+
+    api, stats, results = asyncio.run(scenario())
+
+    assert stats.sent == 55 and stats.failed == 5 and stats.unreachable == 5
+    assert {chat_id for chat_id, result in results.items() if result == broadcast.BLOCKED} == {5, 6, 7}
+    assert {chat_id for chat_id, result in results.items() if result == broadcast.NOT_FOUND} == {8, 9}
+    # Каждый получатель получил ровно одно сообщение; после 429 — повтор той же отправки
+    assert all(len(api.sent_to(chat_id)) == 1 for chat_id in recipients if chat_id != 1)
+    assert len(api.sent_to(1)) == 2
+
+    # После паузы по RetryAfter отправки продолжаются с обычной скоростью, без всплеска
+    throttled_at = api.sent_to(1)[0][0]
+    resumed = [at for at, _, _ in api.calls if at >= throttled_at + 1.0]
+    assert resumed
+    burst = [at for at in resumed if at < resumed[0] + 0.1]
+    assert len(burst) <= 50 * 0.1 + 2
+
+
+def test_failed_result_handler_stops_all_sends():
+    async def scenario():
+        async with FakeBotAPI(latency=0.01) as api:
+            bot = api.bot()
+            handled = []
+
+            async def on_result(chat_id, result):
+                handled.append(chat_id)
+                if len(handled) == 5:
+                    raise RuntimeError("database is locked")
+
+            with pytest.raises(RuntimeError):
+                await broadcast.run_broadcast(
+                    list(range(1, 41)), sender(bot), on_result=on_result, rate=1000, concurrency=4
+                )
+            sent_at_failure = len(api.calls)
+            await asyncio.sleep(0.3)
+            await bot.session.close()
+            return sent_at_failure, len(api.calls)
+
+    sent_at_failure, sent_later = asyncio.run(scenario())
+
+    # Отправки, уже начатые к моменту ошибки, — не больше двух на воркер
+    assert sent_at_failure <= 5 + 2 * 4
+    assert sent_later == sent_at_failure
+
+
+def test_token_bucket_does_not_burst_after_pause():
+    async def scenario():
+        bucket = broadcast.TokenBucket(rate=20)
+        bucket.pause(0.3)
+        loop = asyncio.get_running_loop()
+        await bucket.acquire()
+        resumed_at = loop.time()
+        acquired = 1
+        while loop.time() - resumed_at < 0.1:
+            await bucket.acquire()
+            acquired += 1
+        return acquired
+
+    # За 0.1 с при 20/с — два-три токена, а не весь запас (20)
+    assert asyncio.run(scenario()) <= 4
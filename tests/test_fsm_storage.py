@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import pytest
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import database as db
+import fsm_storage
+
+KEY = StorageKey(bot_id=42, chat_id=7, user_id=7)
+
+
+class PostStates(StatesGroup):
+    title = State()
+
+
+def test_sqlite_storage_round_trip_survives_restart(run_db):
+    storage = fsm_storage.SQLiteStorage(ttl=60)
+
+    async def scenario():
+        await storage.set_state(KEY, PostStates.title)
+        await storage.set_data(KEY, {"title": "Заголовок"})
+        # Перезапуск: пул закрывается и открывается заново на том же файле
+        await db.close_pool()
+        await db.open_pool()
+        return await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert run_db(scenario) == (PostStates.title.state, {"title": "Заголовок"})
+
+
+def test_sqlite_storage_expires_idle_records(run_db):
+    storage = fsm_storage.SQLiteStorage(ttl=0.2)
+
+    async def scenario():
+        await storage.set_state(KEY, PostStates.title)
+        await storage.set_data(KEY, {"title": "old"})
+        await asyncio.sleep(0.3)
+        expired = await storage.get_state(KEY), await storage.get_data(KEY)
+
+        # Новое состояние после истечения срока не подхватывает старые данные
+        await storage.set_state(KEY, PostStates.title)
+        return expired, await storage.get_data(KEY)
+
+    expired, data_after_restart = run_db(scenario)
+
+    assert expired == (None, {})
+    assert data_after_restart == {}
+
+
+def test_sqlite_storage_cleanup_removes_expired_rows(run_db):
+    storage = fsm_storage.SQLiteStorage(ttl=0.1, cleanup_interval=0.2)
+
+    async def scenario():
+        await storage.set_state(KEY, PostStates.title)
+        await fsm_storage.SQLiteStorage(ttl=60).set_state(
+            StorageKey(bot_id=42, chat_id=8, user_id=8), PostStates.title
+        )
+        storage.start_cleanup()
+        await asyncio.sleep(0.35)
+        await storage.close()
+        async with db.reading() as conn:
+            cursor = await conn.execute("SELECT COUNT(*) FROM fsm_records")
+            return (await cursor.fetchone())[0]
+
+    assert run_db(scenario) == 1
+
+
+@pytest.fixture
+def fake_redis_url():
+    """Локальный сервер с протоколом Redis (fakeredis)"""
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis_storage_round_trip_with_ttl(fake_redis_url):
+    async def scenario():
+        storage = fsm_storage.create_storage("redis", ttl=30, redis_url=fake_redis_url)
+        try:
+            await storage.set_state(KEY, PostStates.title)
+            await storage.set_data(KEY, {"title": "Заголовок"})
+            state, data = await storage.get_state(KEY), await storage.get_data(KEY)
+            ttls = [await storage.redis.ttl(storage.key_builder.build(KEY, part)) for part in ("state", "data")]
+            return state, data, ttls
+        finally:
+            await storage.close()
+
+    state, data, ttls = asyncio.run(scenario())
+
+    assert state == PostStates.title.state
+    assert data == {"title": "Заголовок"}
+    assert all(0 < ttl <= 30 for ttl in ttls)
+
+
+def test_unknown_storage_is_rejected():
+    with pytest.raises(ValueError):
+        fsm_storage.create_storage("mongo")
+    with pytest.raises(ValueError):
+        fsm_storage.create_storage("redis")
@@ -0,0 +1,27 @@
+import asyncio
+
+from aiogram.methods import SendMessage
+
+import gateway
+
+
+def test_no_burst_after_retry_after_pause():
+    async def scenario():
+        outbound = gateway.OutboundGateway(rate=20, chat_rate=100, chat_burst=100)
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(asyncio.get_running_loop().time())
+
+        outbound.pause(0.3)
+        paused_at = asyncio.get_running_loop().time()
+        await asyncio.gather(*(
+            outbound(make_request, None, SendMessage(chat_id=chat_id, text="x")) for chat_id in range(20)
+        ))
+        return paused_at, sent
+
+    paused_at, sent = asyncio.run(scenario())
+
+    assert min(sent) >= paused_at + 0.3
+    # За первые 0.1 с после паузы при 20/с — два-три вызова, а не весь запас (20)
+    assert len([at for at in sent if at < min(sent) + 0.1]) <= 4
@@ -0,0 +1,89 @@
+import math
+
+import pytest
+
+import database as db
+from hll import PRECISION, HyperLogLog
+
+# Стандартная ошибка HyperLogLog — 1.04 / sqrt(m); допускаем четыре таких ошибки
+RELATIVE_ERROR = 4 * 1.04 / math.sqrt(1 << PRECISION)
+
+
+@pytest.mark.parametrize("cardinality", [10, 100, 1000, 10000, 100000])
+def test_estimate_within_error_bounds(cardinality):
+    sketch = HyperLogLog().update(range(cardinality))
+
+    assert abs(sketch.count() - cardinality) <= max(1, cardinality * RELATIVE_ERROR)
+
+
+def test_duplicates_do_not_change_estimate():
+    sketch = HyperLogLog().update(range(5000))
+    estimate = sketch.count()
+
+    for _ in range(10):
+        sketch.update(range(5000))
+
+    assert sketch.count() == estimate
+
+
+def test_merge_equals_sketch_of_union():
+    # Пересекающиеся «дни»: объединение должно считать каждого пользователя один раз
+    days = [range(day * 1000, day * 1000 + 3000) for day in range(7)]
+    week = HyperLogLog()
+    for users in days:
+        week.merge(HyperLogLog().update(users))
+
+    union = HyperLogLog().update(range(0, 9000))
+    assert week.to_bytes() == union.to_bytes()
+    assert abs(week.count() - 9000) <= 9000 * RELATIVE_ERROR
+
+
+def test_serialization_round_trip():
+    sketch = HyperLogLog().update(range(1234))
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+
+    assert len(sketch.to_bytes()) == 1 << PRECISION
+    assert restored.count() == sketch.count()
+
+
+def test_reach_counts_unique_viewers(run_db):
+    async def scenario():
+        async with db.writing() as conn:
+            cursor = await conn.execute("INSERT INTO posts (title, description) VALUES ('p', 'd')")
+            post_id = cursor.lastrowid
+        # Каждый из 3000 пользователей открывает пост пять раз
+        for _ in range(5):
+            for user_id in range(3000):
+                await db.increment_post_views(post_id, user_id)
+        await db.flush_events()
+        return await db.get_reach("post", post_id)
+
+    week, month, total = run_db(scenario)
+
+    assert week == month == total
+    assert abs(total - 3000) <= 3000 * RELATIVE_ERROR
+
+
+def test_stored_events_are_backfilled_in_background(run_db):
+    async def scenario():
+        async with db.writing() as conn:
+            cursor = await conn.execute("INSERT INTO posts (title, description) VALUES ('p', 'd')")
+            post_id = cursor.lastrowid
+            # События, сохранённые до появления слепков, — мимо буфера
+            await conn.executemany(
+                "INSERT INTO post_views (post_id, user_id, viewed_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                [(post_id, user_id % 2000) for user_id in range(5000)]
+            )
+            # Миграция 7 только запоминает, до какого id заполнять
+            for statement in db.MIGRATIONS[6][2:]:
+                await conn.execute(statement)
+        before = await db.get_reach("post", post_id)
+
+        assert await db.backfill_sketches(chunk_size=1000) == 5000
+        assert await db.backfill_sketches(chunk_size=1000) == 0
+        return before, await db.get_reach("post", post_id)
+
+    before, after = run_db(scenario)
+
+    assert before == (0, 0, 0)
+    assert all(abs(count - 2000) <= 2000 * RELATIVE_ERROR for count in after)
@@ -0,0 +1,45 @@
+import pytest
+
+import database as db
+
+
+async def query_plan(sql: str, params=()):
+    async with db.reading() as conn:
+        cursor = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return " | ".join(row[-1] for row in await cursor.fetchall())
+
+
+def test_migrations_reach_latest_version(run_db):
+    async def scenario():
+        async with db.reading() as conn:
+            return await db.get_schema_version(conn)
+
+    assert run_db(scenario) == len(db.MIGRATIONS)
+
+
+@pytest.mark.parametrize("sql, params, index", [
+    ("SELECT id, title FROM posts WHERE category_id = ? ORDER BY id", (1,), "idx_posts_category"),
+    ("SELECT id, title FROM posts WHERE subcategory_id = ? ORDER BY id", (1,), "idx_posts_subcategory"),
+    ("SELECT id, name FROM subcategories WHERE category_id = ?", (1,), "idx_subcategories_category"),
+    ("SELECT COUNT(*) FROM post_views WHERE post_id = ? AND viewed_at >= ?", (1, "2024-01-01"),
+     "idx_post_views_post"),
+    ("SELECT viewed_at FROM post_views WHERE user_id = ?", (1,), "idx_post_views_user"),
+    ("SELECT COUNT(*) FROM post_views WHERE viewed_at >= ?", ("2024-01-01",), "idx_post_views_date"),
+    ("SELECT COUNT(*) FROM marathon_clicks WHERE marathon_id = ? AND clicked_at >= ?", (1, "2024-01-01"),
+     "idx_marathon_clicks_marathon"),
+    ("SELECT clicked_at FROM marathon_clicks WHERE user_id = ?", (1,), "idx_marathon_clicks_user"),
+    ("SELECT COUNT(*) FROM marathon_clicks WHERE clicked_at >= ?", ("2024-01-01",), "idx_marathon_clicks_date"),
+])
+def test_lookup_uses_index(run_db, sql, params, index):
+    plan = run_db(lambda: query_plan(sql, params))
+
+    assert f"INDEX {index}" in plan
+    assert "SCAN posts" not in plan and "SCAN post_views" not in plan
+
+
+def test_post_titles_page_is_covered_by_index(run_db):
+    plan = run_db(lambda: query_plan(
+        "SELECT id, title FROM posts WHERE category_id = ? AND id > ? ORDER BY id LIMIT 10", (1, 0)
+    ))
+
+    assert "USING COVERING INDEX idx_posts_category" in plan
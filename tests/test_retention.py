@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+
+import database as db
+
+RETENTION_DAYS = 30
+SIMULATED_DAYS = 150
+VIEWS_PER_DAY = 400
+USERS = 2000
+
+
+class FakeDatetime(datetime):
+    """datetime, у которого now() возвращает смоделированное время"""
+    current = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current.astimezone(tz) if tz else cls.current.replace(tzinfo=None)
+
+
+async def database_size():
+    async with db.reading() as conn:
+        cursor = await conn.execute("PRAGMA page_count")
+        pages = (await cursor.fetchone())[0]
+        cursor = await conn.execute("PRAGMA page_size")
+        return pages * (await cursor.fetchone())[0]
+
+
+async def count(table: str):
+    async with db.reading() as conn:
+        cursor = await conn.execute(f"SELECT COUNT(*) FROM {table}")
+        return (await cursor.fetchone())[0]
+
+
+def test_database_size_stays_flat_under_months_of_events(run_db, monkeypatch):
+    monkeypatch.setattr(db, "datetime", FakeDatetime)
+    FakeDatetime.current = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    async def scenario():
+        async with db.writing() as conn:
+            cursor = await conn.execute("INSERT INTO posts (title, description) VALUES ('p', 'd')")
+            post_id = cursor.lastrowid
+        await db.add_marathon("m", "https://example.org")
+        marathon_id = (await db.get_marathons())[-1][0]
+
+        sizes = []
+        event = 0
+        for _ in range(SIMULATED_DAYS):
+            for i in range(VIEWS_PER_DAY):
+                FakeDatetime.current += timedelta(seconds=86400 / VIEWS_PER_DAY)
+                event += 1
+                await db.increment_post_views(post_id, event % USERS)
+                if i % 4 == 0:
+                    await db.increment_marathon_clicks(marathon_id, event % USERS)
+            await db.flush_events()
+            await db.compact_events()
+            await db.prune_events(RETENTION_DAYS)
+            sizes.append(await database_size())
+        return sizes, await count("post_views"), await count("post_views_daily")
+
+    sizes, raw_views, daily_rows = run_db(scenario)
+
+    # Сырые события хранятся только за срок хранения, сводки по дням — за всё время
+    assert raw_views <= (RETENTION_DAYS + 1) * VIEWS_PER_DAY
+    assert daily_rows >= SIMULATED_DAYS
+    # После заполнения окна хранения файл перестаёт расти
+    steady = sizes[2 * RETENTION_DAYS]
+    assert max(sizes[2 * RETENTION_DAYS:]) <= steady * 1.1, (steady, max(sizes))
@@ -0,0 +1,169 @@
+import asyncio
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import database as db
+from scheduler import PublishScheduler, offpeak_window, parse_local_time
+
+TZ = "Europe/Moscow"
+
+
+def local(*args):
+    return datetime(*args, tzinfo=ZoneInfo(TZ)).timestamp()
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_tick_fires_only_when_due():
+    clock = FakeClock(1000.0)
+    fired = []
+
+    async def fire(now):
+        fired.append(now)
+
+    async def scenario():
+        scheduler = PublishScheduler(fire, clock=clock, max_sleep=60.0)
+        scheduler.add(1030.0)
+        scheduler.add(1010.0)
+        scheduler.add(1010.0)
+
+        assert await scheduler.tick() == 10.0
+        clock.now = 1009.0
+        assert await scheduler.tick() == 1.0
+        assert fired == []
+
+        # Обе записи на 1010 забираются одним срабатыванием
+        clock.now = 1012.0
+        assert await scheduler.tick() == 18.0
+        assert fired == [1012.0]
+
+        clock.now = 1030.0
+        assert await scheduler.tick() == 60.0
+        assert fired == [1012.0, 1030.0]
+        assert scheduler.next_run_at() is None
+
+    asyncio.run(scenario())
+
+
+def test_sleep_is_capped_by_max_sleep():
+    clock = FakeClock(0.0)
+
+    async def scenario():
+        scheduler = PublishScheduler(lambda now: None, clock=clock, max_sleep=60.0)
+        scheduler.add(3600.0)
+        return await scheduler.tick()
+
+    assert asyncio.run(scenario()) == 60.0
+
+
+def test_failed_fire_is_retried():
+    clock = FakeClock(10.0)
+    fired = []
+
+    async def fire(now):
+        fired.append(now)
+        if len(fired) == 1:
+            raise RuntimeError("database is locked")
+
+    async def scenario():
+        scheduler = PublishScheduler(fire, clock=clock, retry_delay=5.0)
+        scheduler.add(5.0)
+        scheduler.add(20.0)
+
+        # Неудачное срабатывание не теряется: повтор через retry_delay
+        assert await scheduler.tick() == 5.0
+        clock.now = 15.0
+        assert await scheduler.tick() == 5.0
+        assert fired == [10.0, 15.0]
+
+    asyncio.run(scenario())
+
+
+def test_offpeak_window_crossing_midnight():
+    hours = (22, 2)
+
+    # Ночью окно, начавшееся вчера, ещё идёт
+    assert offpeak_window(local(2026, 10, 17, 1, 0), hours, TZ) == (local(2026, 10, 16, 22), local(2026, 10, 17, 2))
+    # Днём ближайшее окно — сегодня вечером
+    assert offpeak_window(local(2026, 10, 17, 12, 0), hours, TZ) == (local(2026, 10, 17, 22), local(2026, 10, 18, 2))
+
+
+def test_parse_local_time_rolls_forward():
+    now = local(2026, 10, 17, 12, 0)
+
+    assert parse_local_time("12:30", now, TZ) == local(2026, 10, 17, 12, 30)
+    assert parse_local_time("11:00", now, TZ) == local(2026, 10, 18, 11, 0)
+    assert parse_local_time("01.01 09:00", now, TZ) == local(2027, 1, 1, 9, 0)
+    assert parse_local_time("25.12.2026 10:30", now, TZ) == local(2026, 12, 25, 10, 30)
+    assert parse_local_time("завтра", now, TZ) is None
+
+
+def test_parse_local_time_feb_29():
+    # После 29.02 високосного года — следующий високосный год
+    assert parse_local_time("29.02 10:00", local(2028, 3, 5, 12, 0), TZ) == local(2032, 2, 29, 10, 0)
+    assert parse_local_time("29.02 10:00", local(2027, 1, 5, 12, 0), TZ) == local(2028, 2, 29, 10, 0)
+    assert parse_local_time("29.02.2027 10:00", local(2026, 10, 17, 12, 0), TZ) is None
+
+
+def test_due_posts_are_claimed_once(run_db):
+    async def scenario():
+        first = await db.schedule_post(1, 100.0)
+        second = await db.schedule_post(2, 200.0)
+
+        assert await db.get_pending_schedule_times() == [100.0, 200.0]
+        assert await db.claim_due_scheduled_posts(99.0) == []
+        claimed = await db.claim_due_scheduled_posts(150.0)
+        assert [row[0] for row in claimed] == [first]
+        # Повторное срабатывание не запускает ту же публикацию ещё раз
+        assert await db.claim_due_scheduled_posts(150.0) == []
+        assert await db.get_pending_schedule_times() == [200.0]
+        assert second not in [row[0] for row in claimed]
+
+    run_db(scenario)
+
+
+def test_scheduled_post_takes_status_of_its_job(run_db):
+    async def scenario():
+        statuses = {}
+        for job_status in ("done", "failed"):
+            schedule_id = await db.schedule_post(1, 100.0)
+            await db.claim_due_scheduled_posts(100.0)
+            job_id = await db.create_broadcast_job(1, schedule_id=schedule_id)
+            # Так же завершается и рассылка, продолженная после перезапуска
+            await db.finish_broadcast_job(job_id, job_status)
+            async with db.reading() as conn:
+                cursor = await conn.execute("SELECT status FROM scheduled_posts WHERE id = ?", (schedule_id,))
+                statuses[job_status] = (await cursor.fetchone())[0]
+        return statuses
+
+    assert run_db(scenario) == {"done": "done", "failed": "failed"}
+
+
+def test_interrupted_posts_are_recovered_on_restart(run_db):
+    async def scenario():
+        without_job = await db.schedule_post(1, 100.0)
+        offpeak = await db.schedule_post(2, 100.0, offpeak=True)
+        running = await db.schedule_post(3, 100.0)
+        await db.claim_due_scheduled_posts(100.0)
+        offpeak_job = await db.create_broadcast_job(2, schedule_id=offpeak)
+        await db.create_broadcast_job(3, schedule_id=running)
+
+        # Сбой между захватом публикации и созданием задания оставил её started без job_id
+        await db.recover_scheduled_posts()
+        async with db.reading() as conn:
+            cursor = await conn.execute("SELECT id, status FROM scheduled_posts ORDER BY id")
+            statuses = dict(await cursor.fetchall())
+            cursor = await conn.execute("SELECT status FROM broadcast_jobs WHERE id = ?", (offpeak_job,))
+            offpeak_job_status = (await cursor.fetchone())[0]
+        return statuses, offpeak_job_status, (without_job, offpeak, running)
+
+    statuses, offpeak_job_status, (without_job, offpeak, running) = run_db(scenario)
+
+    assert statuses == {without_job: "pending", offpeak: "pending", running: "started"}
+    assert offpeak_job_status == "paused"
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, Update, User
+
+from middlewares import UpdateScheduler, setup_update_scheduler
+
+USER_ID = 42
+
+
+class PostStates(StatesGroup):
+    title = State()
+    description = State()
+
+
+def message_update(update_id: int, text: str, user_id: int = USER_ID):
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name="Admin"),
+            text=text,
+        ),
+    )
+
+
+def make_dispatcher(seen: list, concurrency: int = 8):
+    dp = Dispatcher(storage=MemoryStorage())
+    router = Router()
+    dp.include_router(router)
+    scheduler = UpdateScheduler(concurrency)
+    setup_update_scheduler(dp, scheduler)
+
+    @router.message(PostStates.title)
+    async def title(message: Message, state: FSMContext):
+        # Медленный обработчик: второе сообщение приходит, пока первое ещё обрабатывается
+        await asyncio.sleep(0.05)
+        seen.append(("title", message.text))
+        await state.set_state(PostStates.description)
+
+    @router.message(PostStates.description)
+    async def description(message: Message, state: FSMContext):
+        seen.append(("description", message.text))
+        await state.clear()
+
+    @router.message()
+    async def other(message: Message):
+        await asyncio.sleep(0.05)
+        seen.append(("other", message.text))
+
+    return dp, scheduler
+
+
+def test_fast_messages_follow_fsm_state():
+    seen = []
+
+    async def scenario():
+        dp, scheduler = make_dispatcher(seen)
+        bot = Bot("42:TEST")
+        key = StorageKey(bot_id=bot.id, chat_id=USER_ID, user_id=USER_ID)
+        await dp.storage.set_state(key, PostStates.title)
+
+        await asyncio.gather(
+            dp.feed_update(bot, message_update(1, "T")),
+            dp.feed_update(bot, message_update(2, "D")),
+        )
+        assert scheduler.backlog == 0 and scheduler.chats_queued == 0
+        await bot.session.close()
+
+    asyncio.run(scenario())
+
+    assert seen == [("title", "T"), ("description", "D")]
+
+
+def test_different_users_run_in_parallel_up_to_concurrency():
+    seen = []
+
+    async def scenario():
+        dp, _ = make_dispatcher(seen, concurrency=4)
+        bot = Bot("42:TEST")
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(
+            dp.feed_update(bot, message_update(i, str(i), user_id=1000 + i)) for i in range(8)
+        ))
+        await bot.session.close()
+        return asyncio.get_running_loop().time() - started
+
+    elapsed = asyncio.run(scenario())
+
+    assert len(seen) == 8
+    # 8 обработчиков по 0.05 с при 4 слотах — две волны, а не восемь и не одна
+    assert 0.09 <= elapsed < 0.3